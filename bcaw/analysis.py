@@ -0,0 +1,308 @@
+#!/usr/bin/python
+# coding=UTF-8
+#
+# BitCurator Access Webtools (Disk Image Access for the Web)
+# Copyright (C) 2014 - 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""File analysis, MIME identification, hashing and text extraction, backed by
+the persistent analysis cache."""
+import datetime
+import logging
+import os
+import time
+from collections import OrderedDict
+from sqlalchemy.exc import IntegrityError
+
+from bcaw import app
+from bcaw import catalog
+from bcaw.const import AnalysisStatus, ConfKey, FileFlds
+from bcaw.blob_store import BlobStore
+from bcaw.disk_utils import FileSysEle
+from bcaw.extraction import ExtractionError, ExtractionPool
+from bcaw.known_files import KnownFiles
+from bcaw.model import db, ByteSequence, Catalog, FileAnalysis, FileHash, Image, Partition
+from bcaw.utilities import identify_mime_path, identify_mime_buffer, map_mime_to_ext, \
+    DigestTee
+
+# Most other copies of a file's content listed on its analysis page
+MAX_OCCURRENCES = 20
+
+def cached_analysis(image, image_part, fs_ele, path=None):
+    """Returns the FileAnalysis for fs_ele, analysing the file and storing the
+    results, with the file's path, if it hasn't been analysed before or a
+    previous analysis is stale.
+    """
+    analysis = FileAnalysis.byAddr(image_part.id, fs_ele.addr)
+    if analysis is not None:
+        if not is_stale(analysis):
+            return analysis
+        analysis.updateFrom(analyse_element(image, image_part, fs_ele, analysis.path))
+        FileAnalysis.save(analysis)
+        return analysis
+    analysis = analyse_element(image, image_part, fs_ele, path)
+    try:
+        FileAnalysis.save(analysis)
+    except IntegrityError:
+        # Analysed concurrently by another request, use the stored results
+        db.session.rollback()
+        return FileAnalysis.byAddr(image_part.id, fs_ele.addr)
+    return analysis
+
+def request_analysis(image, image_part, fs_ele, path=None):
+    """Returns the FileAnalysis for fs_ele. If ASYNC_ANALYSIS is configured a
+    file that hasn't been analysed is queued as a Celery job and the queued
+    FileAnalysis returned for the page to poll. The stored record collapses
+    duplicate requests onto the one job, a job that hasn't finished within
+    ANALYSIS_TIMEOUT is assumed lost and queued again, as is a failed job
+    ANALYSIS_TIMEOUT after it failed. path is the file's
+    path if it was resolved in the image, otherwise the stored path comes
+    from resolve_path, display paths supplied by clients aren't stored.
+    """
+    if path is None:
+        path = resolve_path(image, image_part, fs_ele.addr)
+    if not app.config[ConfKey.ASYNC_ANALYSIS]:
+        return cached_analysis(image, image_part, fs_ele, path)
+    analysis = FileAnalysis.byAddr(image_part.id, fs_ele.addr)
+    if analysis is not None and not is_stale(analysis):
+        return analysis
+    if analysis is None:
+        # The header's enough to show the type while the analysis is queued
+        analysis = FileAnalysis(image_part.id, fs_ele.addr,
+                                mime_type=sniff_mime(image, image_part, fs_ele),
+                                path=path,
+                                analysed=datetime.datetime.utcnow(),
+                                status=AnalysisStatus.QUEUED)
+        try:
+            FileAnalysis.save(analysis)
+        except IntegrityError:
+            # Requested concurrently, the other request queued the job
+            db.session.rollback()
+            return FileAnalysis.byAddr(image_part.id, fs_ele.addr)
+    else:
+        logging.warn("Analysis of %s in partition %d %s, requeueing", fs_ele.path,
+                     image_part.id, "failed" if analysis.isFailed() else "timed out")
+        analysis.status = AnalysisStatus.QUEUED
+        analysis.analysed = datetime.datetime.utcnow()
+        FileAnalysis.save(analysis)
+    # Imported here as the Celery task module imports the application
+    from bcaw_celery_task import bcawAnalyseFileAsynchronously
+    try:
+        bcawAnalyseFileAsynchronously.delay(image_part.id, fs_ele.addr, fs_ele.path)
+    except Exception:
+        logging.exception("Failed to queue analysis, analysing %s in request",
+                          fs_ele.path)
+        run_analysis(image_part.id, fs_ele.addr, fs_ele.path)
+    return analysis
+
+def run_analysis(part_id, addr, path):
+    """Runs a queued analysis of the file with meta address addr, storing the
+    results or the failure in its FileAnalysis.
+    """
+    analysis = FileAnalysis.byAddr(part_id, addr)
+    if analysis is None or analysis.isComplete():
+        return analysis
+    analysis.status = AnalysisStatus.RUNNING
+    FileAnalysis.save(analysis)
+    image_part = Partition.byId(part_id)
+    image = Image.byId(image_part.image_id)
+    try:
+        fs_ele = FileSysEle.fromImageInode(image.path, image_part, image.bps, addr, path)
+        analysis.updateFrom(analyse_element(image, image_part, fs_ele, analysis.path))
+    except Exception:
+        logging.exception("Analysis of %s in partition %d failed", path, part_id)
+        # The failure may have been the database's, start a fresh transaction
+        db.session.rollback()
+        analysis.status = AnalysisStatus.FAILED
+        # Retried ANALYSIS_TIMEOUT after the failure
+        analysis.analysed = datetime.datetime.utcnow()
+    FileAnalysis.save(analysis)
+    return analysis
+
+def is_stale(analysis):
+    """Checks if an in progress analysis has exceeded ANALYSIS_TIMEOUT, so is
+    assumed lost, or a failed one is older than ANALYSIS_TIMEOUT, so is due
+    a retry."""
+    timeout = datetime.timedelta(seconds=app.config[ConfKey.ANALYSIS_TIMEOUT])
+    return (analysis.isInProgress() or analysis.isFailed()) and \
+           analysis.analysed < datetime.datetime.utcnow() - timeout
+
+def resolve_path(image, image_part, addr):
+    """Returns the path of the file with meta address addr as found by the
+    partition's hashing run, catalog or tree index, or None if none of them
+    are available."""
+    file_hash = FileHash.byAddr(image_part.id, addr)
+    if file_hash is not None:
+        return file_hash.path
+    part_catalog = Catalog.completeForPartId(image_part.id)
+    if part_catalog is not None:
+        return catalog.path_for_addr(part_catalog, addr)
+    tree = FileSysEle.getTree(image.path, image_part, image.bps)
+    return tree.pathForAddr(addr) if tree is not None else None
+
+def sniff_mime(image, image_part, fs_ele):
+    """Identifies the MIME type of a file from the first MIME_HEADER_BYTES of
+    its content, returns None if the header isn't enough to decide the type.
+    """
+    try:
+        header = FileSysEle.readHeader(image.path, image_part.start, image.bps,
+                                       fs_ele, app.config[ConfKey.MIME_HEADER_BYTES])
+        return identify_mime_buffer(header)
+    except Exception:
+        logging.exception("Failed to read header of %s", fs_ele.path)
+        return None
+
+def analyse_element(image, image_part, fs_ele, path=None):
+    """Analyses a file read from an image, returning an unsaved FileAnalysis
+    linked to the stored ByteSequence for its content. Content already
+    analysed, in any image, isn't identified or extracted again. Files hashed
+    before whose content is in the BlobStore are analysed from the store,
+    otherwise files are only copied from the image if there's text to extract
+    or their type can't be identified from the header. Copies are added to
+    the BlobStore. path is the file's path stored with the analysis.
+    """
+    started = time.time()
+    sequence = None
+    stored = stored_digests(image_part.id, fs_ele.addr)
+    if stored is not None:
+        sequence = ByteSequence.bySha1(stored['sha1'])
+        if sequence is None:
+            with BlobStore.localCopy(stored['sha1']) as blob_path:
+                if blob_path is not None:
+                    sequence = store_sequence(analyse_file(blob_path, fs_ele.path, stored))
+    if sequence is None:
+        sequence = read_sequence(image, image_part, fs_ele)
+    analysis = FileAnalysis(image_part.id, fs_ele.addr, path=path,
+                            seconds=time.time() - started,
+                            analysed=datetime.datetime.utcnow())
+    analysis.setByteSequence(sequence)
+    return analysis
+
+def read_sequence(image, image_part, fs_ele):
+    """Returns the stored ByteSequence for a file's content, reading and
+    hashing the file from the image and analysing the content if it's new.
+    """
+    # Hash the content as it's read rather than re-reading it
+    digests = DigestTee(set(app.config[ConfKey.HASH_ALGORITHMS]) | set(['sha1']))
+    mime_type = sniff_mime(image, image_part, fs_ele)
+    if mime_type is not None and map_mime_to_ext(mime_type) is None:
+        for _ in digests.tee(FileSysEle.payloadGenerator(image.path, image_part.start,
+                                                         image.bps, fs_ele)):
+            pass
+        hexdigests = digests.hexdigests()
+        sequence = ByteSequence.bySha1(hexdigests['sha1']) or store_sequence(
+            ByteSequence(hexdigests, fs_ele.size, mime_type,
+                         is_known=KnownFiles.isKnown(hexdigests['sha1'])))
+    else:
+        with FileSysEle.spooledCopy(image.path, image_part.start, image.bps,
+                                    fs_ele, digests) as spool_path:
+            hexdigests = digests.hexdigests()
+            BlobStore.put(hexdigests['sha1'], spool_path)
+            sequence = ByteSequence.bySha1(hexdigests['sha1']) or store_sequence(
+                analyse_file(spool_path, fs_ele.path, hexdigests, mime_type))
+    return sequence
+
+def stored_digests(part_id, addr):
+    """Returns the hex digests, keyed by algorithm, stored for a file by an
+    analysis or partition hashing run, or None if it hasn't been hashed."""
+    for hashed in [FileAnalysis.byAddr(part_id, addr), FileHash.byAddr(part_id, addr)]:
+        if hashed is not None and hashed.sha1:
+            return {'sha1': hashed.sha1, 'md5': hashed.md5, 'sha256': hashed.sha256}
+    return None
+
+def analyse_file(temp_file, file_path, digests, mime_type=None):
+    """Identifies and extracts the text of the file at temp_file, a copy of
+    the file at file_path in an image, digests are the copy's hex digests
+    keyed by algorithm. Returns an unsaved ByteSequence for the content. The
+    file is only identified if mime_type is None. Text extraction failures
+    are recorded in the sequence's error, known files aren't extracted if
+    KNOWN_FILES_SKIP_EXTRACTION is set.
+    """
+    if mime_type is None:
+        mime_type = identify_mime_path(temp_file)
+    logging.debug("MIME: %s SHA1:%s", mime_type, digests['sha1'])
+    extension = map_mime_to_ext(mime_type)
+    full_text = None
+    error = None
+    is_known = KnownFiles.isKnown(digests['sha1'])
+    if is_known and app.config[ConfKey.KNOWN_FILES_SKIP_EXTRACTION]:
+        extension = None
+    if extension is not None:
+        try:
+            logging.debug("Textract for doc %s, extension map val %s", file_path, extension)
+            full_text = ExtractionPool.extract(temp_file, extension)
+        except ExtractionError as excep:
+            logging.warn("Text extraction of %s failed: %s", file_path, excep)
+            error = str(excep)[:256]
+    return ByteSequence(digests, os.path.getsize(temp_file), mime_type,
+                        full_text=full_text, error=error, is_known=is_known)
+
+def store_sequence(sequence):
+    """Saves a new ByteSequence, returning the sequence stored for the same
+    content if a concurrent analysis stored it first."""
+    try:
+        ByteSequence.save(sequence)
+        return sequence
+    except IntegrityError:
+        db.session.rollback()
+        return ByteSequence.bySha1(sequence.sha1)
+
+def content_occurrences(analysis):
+    """Returns up to MAX_OCCURRENCES other files with the same content as an
+    analysed file, in any image, as (image, partition, meta address, path)
+    tuples. Files are found by digest in the analysis cache and partition
+    hashing runs, both indexed by SHA-1.
+    """
+    if not analysis.sha1:
+        return []
+    found = OrderedDict()
+    for part_id, addr, path in FileAnalysis.occurrencesOf(analysis.sha1, MAX_OCCURRENCES + 1) + \
+                               FileHash.occurrencesOf(analysis.sha1, MAX_OCCURRENCES + 1):
+        if (part_id, addr) != (analysis.partition_id, analysis.addr):
+            found[(part_id, addr)] = found.get((part_id, addr)) or path
+    keys = list(found)[:MAX_OCCURRENCES]
+    if not keys:
+        return []
+    partitions = dict((part.id, part) for part in
+                      Partition.query.filter(Partition.id.in_(set(key[0] for key in keys))))
+    images = dict((image.id, image) for image in
+                  Image.query.filter(Image.id.in_(set(part.image_id
+                                                      for part in partitions.values()))))
+    return [(images[partitions[part_id].image_id], partitions[part_id], addr,
+             found[(part_id, addr)]) for part_id, addr in keys]
+
+def prefill_partition(part_id, candidates_only=True):
+    """Fills the analysis cache for every file in a partition not yet analysed,
+    or only the text extraction candidates if candidates_only is set, known
+    files hashed by a partition hashing run aren't candidates. Failed analyses
+    are logged and skipped.
+    """
+    image_part = Partition.byId(part_id)
+    image = Image.byId(image_part.image_id)
+    analysed = FileAnalysis.addrsForPartId(part_id)
+    known = FileHash.knownAddrsForPartId(part_id)
+    count = 0
+    for path, entry in FileSysEle.walkPartitionPaths(image.path, image_part, image.bps):
+        if entry[FileFlds.IS_DIR] or entry[FileFlds.ADDR] in analysed:
+            continue
+        if entry[FileFlds.ADDR] in known:
+            entry[FileFlds.IS_CANDIDATE] = False
+        if candidates_only and not entry[FileFlds.IS_CANDIDATE]:
+            continue
+        analysed.add(entry[FileFlds.ADDR])
+        fs_ele = FileSysEle(path, entry[FileFlds.SIZE],
+                            entry[FileFlds.MODE], entry[FileFlds.MTIME],
+                            entry[FileFlds.ATIME], entry[FileFlds.CTIME],
+                            entry[FileFlds.ADDR], False, entry[FileFlds.IS_DELETED],
+                            entry[FileFlds.IS_CANDIDATE])
+        try:
+            cached_analysis(image, image_part, fs_ele, path)
+            count += 1
+        except Exception:
+            logging.exception("Failed to analyse %s in partition %d", fs_ele.path, part_id)
+    logging.info("Analysed %d files for partition %d", count, part_id)
+    return count
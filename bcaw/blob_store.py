@@ -0,0 +1,318 @@
+#!/usr/bin/python
+# coding=UTF-8
+#
+# BitCurator Access Webtools (Disk Image Access for the Web)
+# Copyright (C) 2014 - 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""Content addressed store of files extracted from images."""
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from spool import SpoolDir, FILE_MODE, make_shared_dir, pin_file, remove_stale_temps
+from spool import remove_unpinned, touch
+
+BUFF_SIZE = 1024 * 1024
+ZSTD_EXTN = '.zst'
+
+class BlobStore(object):
+    """Size bounded store of file content keyed by SHA-1 digest, so content
+    found in several images is stored once. Blobs live in two levels of
+    directories sharded on the digest's leading hex digits and are zstd
+    compressed if compress is set and the zstandard package is installed.
+    Reading a blob touches its modification time, the least recently used
+    blobs are deleted when the blobs on disk, stored by any process, exceed
+    max_bytes. A max_bytes of 0 disables the store. Each process indexes the
+    blobs on disk when it stores one, blobs stored by other processes since
+    are found on disk by their digest. Blobs read by path are pinned with a
+    shared flock, like SpoolDir files, so no process evicts them while
+    they're in use.
+    """
+    directory = None
+    max_bytes = 0
+    compress = False
+    level = 3
+    # Seconds before a hidden temp file is assumed left by a dead process
+    temp_max_age = 24 * 60 * 60
+    current_bytes = 0
+    hits = 0
+    misses = 0
+    stored = 0
+    evictions = 0
+    __blobs__ = OrderedDict()
+    __lock__ = threading.Lock()
+
+    @classmethod
+    def configure(cls, directory, max_bytes, compress=False, level=3):
+        """Sets the store directory, byte quota and compression, indexing any
+        blobs already stored least recently used first."""
+        with cls.__lock__:
+            cls.directory = directory
+            cls.max_bytes = max(0, int(max_bytes))
+            if compress and zstandard is None:
+                logging.warn("zstandard isn't installed, blobs won't be compressed")
+            cls.compress = bool(compress) and zstandard is not None
+            cls.level = level
+            cls.__blobs__.clear()
+            cls.current_bytes = 0
+            if not cls.max_bytes:
+                return
+            make_shared_dir(directory)
+            remove_stale_temps(directory, cls.temp_max_age)
+            cls._scan()
+            cls._evict()
+
+    @classmethod
+    def isEnabled(cls):
+        return cls.max_bytes > 0
+
+    @classmethod
+    def contains(cls, sha1):
+        with cls.__lock__:
+            return cls.isEnabled() and cls._entry(sha1) is not None
+
+    @classmethod
+    def put(cls, sha1, source_path):
+        """Stores a copy of the file at source_path, whose content has the
+        SHA-1 digest sha1, unless the content is already stored or too big."""
+        if not cls.isEnabled() or not sha1 or cls.contains(sha1) or \
+           os.path.getsize(source_path) > cls.max_bytes:
+            return
+        name = sha1 + (ZSTD_EXTN if cls.compress else '')
+        path = cls._path(name)
+        make_shared_dir(os.path.dirname(os.path.dirname(path)))
+        make_shared_dir(os.path.dirname(path))
+        # Write to a hidden temp name then rename, so no process sees a
+        # partial blob
+        handle, temp_path = tempfile.mkstemp(prefix='.', dir=os.path.dirname(path))
+        try:
+            os.fchmod(handle, FILE_MODE)
+            with os.fdopen(handle, 'wb') as blob, open(source_path, 'rb') as source:
+                if cls.compress:
+                    zstandard.ZstdCompressor(level=cls.level).copy_stream(source, blob)
+                else:
+                    shutil.copyfileobj(source, blob, BUFF_SIZE)
+            os.rename(temp_path, path)
+        except:
+            _remove(temp_path)
+            raise
+        with cls.__lock__:
+            cls.stored += 1
+            # Rescan to count the blobs other processes stored
+            cls._scan()
+            cls._evict()
+
+    @classmethod
+    def open(cls, sha1):
+        """Returns a file like object reading the content stored for sha1,
+        decompressing it if need be, or None if it isn't stored."""
+        with cls.__lock__:
+            entry = cls._entry(sha1) if cls.isEnabled() else None
+            if entry is None:
+                cls.misses += 1
+                return None
+            del cls.__blobs__[sha1]
+            name, size = entry
+            try:
+                # Once open the blob can be read even if it's evicted
+                blob = open(cls._path(name), 'rb')
+            except IOError:
+                # Evicted by another process
+                cls.current_bytes -= size
+                cls.misses += 1
+                return None
+            cls.__blobs__[sha1] = entry
+            cls.hits += 1
+        touch(cls._path(name))
+        if name.endswith(ZSTD_EXTN):
+            return zstandard.ZstdDecompressor().stream_reader(blob)
+        return blob
+
+    @classmethod
+    def chunks(cls, blob, offset, length):
+        """Generator yielding length bytes of an opened blob from offset."""
+        try:
+            if isinstance(blob, file):
+                blob.seek(offset)
+            else:
+                # Decompressed streams can only be read forward
+                while offset > 0:
+                    skipped = blob.read(min(BUFF_SIZE, offset))
+                    if not skipped:
+                        return
+                    offset -= len(skipped)
+            while length > 0:
+                data = blob.read(min(BUFF_SIZE, length))
+                if not data:
+                    return
+                length -= len(data)
+                yield data
+        finally:
+            blob.close()
+
+    @classmethod
+    def verifiedChunks(cls, sha1, blob, length):
+        """Generator yielding the length bytes of an opened blob, the whole of
+        the content stored for sha1, checking them against sha1 as they're
+        read. Each chunk is held back until the next is read, so if the blob
+        doesn't match it's deleted and IOError raised before the last chunk is
+        yielded, cutting the response short."""
+        digest = hashlib.sha1()
+        held = None
+        for data in cls.chunks(blob, 0, length):
+            digest.update(data)
+            if held is not None:
+                yield held
+            held = data
+        if digest.hexdigest() != sha1:
+            logging.error("Blob %s doesn't match its digest, deleting it", sha1)
+            cls.discard(sha1)
+            raise IOError(errno.EIO, "Blob doesn't match its digest", sha1)
+        if held is not None:
+            yield held
+
+    @classmethod
+    def discard(cls, sha1):
+        """Deletes the blob stored for sha1, e.g. if it's corrupt."""
+        with cls.__lock__:
+            entry = cls._entry(sha1) if cls.isEnabled() else None
+            if entry is None:
+                return
+            del cls.__blobs__[sha1]
+            cls.current_bytes -= entry[1]
+        _remove(cls._path(entry[0]))
+
+    @classmethod
+    @contextmanager
+    def localCopy(cls, sha1):
+        """Context manager yielding the path of an uncompressed copy of the
+        content stored for sha1, the blob itself unless it's compressed, or
+        None if the content isn't stored. The blob is pinned until the block
+        exits."""
+        with cls.__lock__:
+            entry = cls._entry(sha1) if cls.isEnabled() else None
+        pin_fd = None
+        if entry is not None and not entry[0].endswith(ZSTD_EXTN):
+            pin_fd = pin_file(cls._path(entry[0]))
+            if pin_fd is None:
+                # Evicted by another process
+                entry = None
+        if entry is None or not os.path.exists(cls._path(entry[0])):
+            yield None
+            return
+        if pin_fd is not None:
+            try:
+                touch(cls._path(entry[0]))
+                yield cls._path(entry[0])
+            finally:
+                os.close(pin_fd)
+            return
+        def _write(spool_file):
+            blob = cls.open(sha1)
+            if blob is None:
+                raise IOError(errno.ENOENT, "Blob evicted", sha1)
+            try:
+                shutil.copyfileobj(blob, spool_file, BUFF_SIZE)
+            finally:
+                blob.close()
+        with SpoolDir.spooled(('blob', sha1), _write) as spool_path:
+            yield spool_path
+
+    @classmethod
+    def stats(cls):
+        """Returns a dictionary of store counters."""
+        with cls.__lock__:
+            lookups = cls.hits + cls.misses
+            return {
+                'directory': cls.directory,
+                'compressed': cls.compress,
+                'blobs': len(cls.__blobs__),
+                'bytes': cls.current_bytes,
+                'max_bytes': cls.max_bytes,
+                'stored': cls.stored,
+                'hits': cls.hits,
+                'misses': cls.misses,
+                'hit_rate': round(float(cls.hits) / lookups, 3) if lookups else 0.0,
+                'evictions': cls.evictions
+            }
+
+    @classmethod
+    def _entry(cls, sha1):
+        """Returns the (name, size) of the blob for sha1, indexing it if it
+        was stored by another process, or None."""
+        entry = cls.__blobs__.get(sha1)
+        if entry is None and sha1:
+            for name in [sha1, sha1 + ZSTD_EXTN]:
+                try:
+                    size = os.path.getsize(cls._path(name))
+                except OSError:
+                    continue
+                entry = cls.__blobs__[sha1] = (name, size)
+                cls.current_bytes += size
+                break
+        return entry
+
+    @classmethod
+    def _scan(cls):
+        """Indexes the blobs on disk least recently used first, counting their
+        bytes. Call with the lock held."""
+        stored = []
+        for root, _, names in os.walk(cls.directory):
+            for name in names:
+                if name.startswith('.'):
+                    # Being written by another process
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                stored.append((stat.st_mtime, name, stat.st_size))
+        cls.__blobs__.clear()
+        cls.current_bytes = 0
+        for _, name, size in sorted(stored):
+            cls.__blobs__[_sha1(name)] = (name, size)
+            cls.current_bytes += size
+
+    @classmethod
+    def _path(cls, name):
+        return os.path.join(cls.directory, name[0:2], name[2:4], name)
+
+    @classmethod
+    def _evict(cls):
+        """Deletes the least recently used blobs no process has pinned while
+        the store exceeds the quota. Call with the lock held."""
+        for sha1 in list(cls.__blobs__):
+            if cls.current_bytes <= cls.max_bytes:
+                break
+            name, size = cls.__blobs__[sha1]
+            if not remove_unpinned(cls._path(name)):
+                continue
+            del cls.__blobs__[sha1]
+            cls.current_bytes -= size
+            cls.evictions += 1
+
+def _sha1(name):
+    return name[:-len(ZSTD_EXTN)] if name.endswith(ZSTD_EXTN) else name
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as excep:
+        if excep.errno != errno.ENOENT:
+            logging.exception("Failed to remove blob " + path)
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# coding=UTF-8
+#
+# BitCurator Access Webtools (Disk Image Access for the Web)
+# Copyright (C) 2014 - 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""Builds and queries the persistent per-partition file system catalog."""
+import logging
+
+from bcaw import app
+from bcaw.const import ConfKey, FileFlds
+from bcaw.disk_utils import FileSysEle, dir_display_path
+from bcaw.model import Catalog, FileEntry, FileHash, Image, Partition
+
+def build_catalog(part_id):
+    """Walks the partition with id part_id once and stores every directory
+    entry found in the file entry table, batching the inserts. Any previous
+    catalog for the partition is replaced. Known files found by a partition
+    hashing run aren't marked as text extraction candidates.
+    """
+    image_part = Partition.byId(part_id)
+    image = Image.byId(image_part.image_id)
+    batch_size = app.config[ConfKey.CATALOG_BATCH_SIZE]
+    logging.info("Building catalog for partition %d of image %s", part_id, image.path)
+
+    catalog = Catalog.byPartId(part_id) or Catalog(part_id)
+    catalog.complete = False
+    catalog.entries = 0
+    Catalog.save(catalog)
+    FileEntry.deleteForPartition(part_id)
+
+    known = FileHash.knownAddrsForPartId(part_id)
+    walker = FileSysEle.walkPartition(image.path, image_part, image.bps)
+    catalog.root_addr = next(walker)
+    batch = []
+    for entry in walker:
+        entry[FileFlds.PARTITION] = part_id
+        if entry[FileFlds.ADDR] in known:
+            entry[FileFlds.IS_CANDIDATE] = False
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            FileEntry.addEntries(batch)
+            catalog.entries += len(batch)
+            del batch[:]
+    if batch:
+        FileEntry.addEntries(batch)
+        catalog.entries += len(batch)
+    catalog.complete = True
+    Catalog.save(catalog)
+    logging.info("Catalogued %d entries for partition %d", catalog.entries, part_id)
+    return catalog
+
+def queue_catalog_build(part_id):
+    """Submits a background catalog build for the partition to Celery."""
+    # Imported here as the Celery task module imports the application
+    from bcaw_celery_task import bcawBuildCatalogAsynchronously
+    try:
+        bcawBuildCatalogAsynchronously.delay(part_id)
+    except Exception:
+        logging.exception("Failed to queue catalog build for partition %d", part_id)
+
+def resolve_path(catalog, path):
+    """Returns the FileSysEle for path from a complete catalog, the root
+    element for the root directory, or None if the path isn't catalogued.
+    """
+    stripped = path.strip('/')
+    if not stripped:
+        return FileSysEle.rootElement()
+    entry = FileEntry.byPath(catalog.partition_id, catalog.root_addr, stripped)
+    if entry is None:
+        return None
+    return FileSysEle.fromCatalogEntry('/' + stripped, entry)
+
+def element_by_addr(catalog, addr, path):
+    """Returns the FileSysEle with meta address addr from a complete catalog,
+    path is used for display only, or None if the address isn't catalogued.
+    """
+    entry = FileEntry.byAddr(catalog.partition_id, addr)
+    if entry is None:
+        return None
+    return FileSysEle.fromCatalogEntry(path, entry)
+
+def path_for_addr(catalog, addr):
+    """Returns the path of the element with meta address addr from a complete
+    catalog, following its parent directories to the root, or None if the
+    address isn't catalogued."""
+    names = []
+    seen = set()
+    while addr != catalog.root_addr:
+        entry = FileEntry.namedByAddr(catalog.partition_id, addr)
+        if entry is None or addr in seen:
+            return None
+        seen.add(addr)
+        names.append(entry.name)
+        addr = entry.parent_addr
+    return u'/' + u'/'.join(reversed(names))
+
+def count_directory(catalog, addr):
+    """Returns the number of entries in the directory with meta address addr
+    from a complete catalog, the root if addr is negative."""
+    return FileEntry.childCount(catalog.partition_id,
+                                catalog.root_addr if addr < 0 else addr)
+
+def list_directory(catalog, addr, path):
+    """Generator yielding the FileSysEle children of the directory with meta
+    address addr from a complete catalog, the root if addr is negative.
+    """
+    parent_addr = catalog.root_addr if addr < 0 else addr
+    parent_path = dir_display_path(path)
+    for entry in FileEntry.children(catalog.partition_id, parent_addr).yield_per(1000):
+        yield FileSysEle.fromCatalogEntry(parent_path + entry.name, entry)
@@ -12,6 +12,7 @@
 # This file contains items that can be configured in BitCurator Access Webtools.
 #
 import os
+import tempfile
 from flask import Flask
 
 # TODO: template these values for flexible install
@@ -32,6 +33,81 @@ class BaseConfig(object):
     DEBUG = True
     LOG_FORMAT = '[%(filename)-15s:%(lineno)-5d] %(message)s'
     LOG_FILE = LOG_ROOT + 'bcaw.log'
+    # Hand whole image downloads to nginx with X-Accel-Redirect, the prefix
+    # must match the internal location in nginx_config
+    IMAGE_ACCEL_REDIRECT = False
+    IMAGE_ACCEL_PREFIX = '/protected-images/'
+    # Cache lifetime in seconds for file content read from (immutable) images
+    CONTENT_MAX_AGE = 365 * 24 * 60 * 60
+    # Celery broker for background jobs, see bcaw_celery_task.py
+    CELERY_BROKER_URL = 'amqp://guest@localhost//'
+    CELERY_RESULT_BACKEND = 'amqp://guest@localhost//'
+    # Run file analysis (text extraction) as Celery jobs polled by the page
+    ASYNC_ANALYSIS = True
+    # Seconds before a queued or running analysis is assumed lost and requeued,
+    # and after which a failed analysis is retried
+    ANALYSIS_TIMEOUT = 60 * 60
+    # Digests calculated while extracting files for analysis, SHA-1 always is
+    HASH_ALGORITHMS = ['md5', 'sha1', 'sha256']
+    # Bytes read from the start of a file to identify its MIME type
+    MIME_HEADER_BYTES = 64 * 1024
+    # Max number of text extraction worker processes run at once per process
+    EXTRACTION_WORKERS = 2
+    # Seconds before a text extraction worker is killed, overridden by extension
+    EXTRACTION_TIMEOUT = 120
+    EXTRACTION_TIMEOUTS = {'pdf': 300, 'ps': 300}
+    # Address space limit in bytes for text extraction workers, 0 for none
+    EXTRACTION_MEMORY_LIMIT = 2 * 1024 * 1024 * 1024
+    # Extensions extracted in process rather than by textract, from txt, html, json
+    NATIVE_EXTRACTION = ['txt', 'html', 'json']
+    # Bytes of a file decoded by native extractors, text and HTML beyond it are
+    # truncated, larger JSON documents fail, 0 for no limit
+    NATIVE_EXTRACTION_BYTES = 64 * 1024 * 1024
+    # Directory and byte quota for files copied out of images for analysis
+    SPOOL_DIR = os.path.join(tempfile.gettempdir(), 'bcaw-spool')
+    SPOOL_BYTES = 1024 * 1024 * 1024
+    # Worker processes hashing a partition, and files hashed between commits
+    HASH_WORKERS = 4
+    HASH_CHECKPOINT_FILES = 500
+    # Seconds without a checkpoint before a queued or running hashing run is
+    # assumed lost and can be resumed
+    HASH_RUN_TIMEOUT = 60 * 60
+    # Reference SHA-1 hash lists of known files, e.g. NSRL RDS NSRLFile.txt
+    KNOWN_HASH_LISTS = []
+    # Directory the lists are built into a sorted digest file shared by all
+    # processes, built on first use or ahead of time by known_files.py
+    KNOWN_HASH_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'bcaw-known')
+    # Don't extract the text of known files
+    KNOWN_FILES_SKIP_EXTRACTION = True
+    # Content addressed store of extracted files, 0 bytes disables it, zstd
+    # compression needs the zstandard package
+    BLOB_STORE_DIR = ROOT + 'blob-store'
+    BLOB_STORE_BYTES = 0
+    BLOB_STORE_COMPRESS = False
+    BLOB_STORE_LEVEL = 3
+    # Max number of disk images each process keeps open in the handle pool
+    IMAGE_POOL_SIZE = 8
+    # Memory map raw (.dd, .raw, .iso) images rather than reading via libtsk
+    MMAP_RAW_IMAGES = True
+    # Memory budget for decoded EWF image chunks, shared per process
+    CHUNK_CACHE_BYTES = 64 * 1024 * 1024
+    # Content reads start at READ_AHEAD_MIN bytes and double up to READ_AHEAD_MAX
+    READ_AHEAD_MIN = 64 * 1024
+    READ_AHEAD_MAX = 4 * 1024 * 1024
+    # Read the next chunk in a background thread while the current one is sent
+    READ_AHEAD_PREFETCH = True
+    # Memory budget for cached directory listings, per process
+    LISTING_CACHE_BYTES = 64 * 1024 * 1024
+    # Number of entries shown per directory listing page
+    LISTING_PAGE_SIZE = 500
+    # Largest page size a listing request may ask for
+    LISTING_PAGE_MAX = 5000
+    # Number of file entries inserted per transaction when cataloguing
+    CATALOG_BATCH_SIZE = 5000
+    # Queue a catalog build (Celery) for partitions added when synching
+    CATALOG_ON_SYNCH = False
+    # Memory budget for in-memory partition tree indexes, 0 disables them
+    TREE_INDEX_BYTES = 0
 
 class DevConfig(BaseConfig):
     DEBUG = True
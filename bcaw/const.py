@@ -21,6 +21,43 @@ class ConfKey(object):
     LOG_FORMAT = 'LOG_FORMAT'
     LOG_FILE = 'LOG_FILE'
     IMAGE_DIR = 'IMAGE_DIR'
+    IMAGE_POOL_SIZE = 'IMAGE_POOL_SIZE'
+    IMAGE_ACCEL_REDIRECT = 'IMAGE_ACCEL_REDIRECT'
+    IMAGE_ACCEL_PREFIX = 'IMAGE_ACCEL_PREFIX'
+    CONTENT_MAX_AGE = 'CONTENT_MAX_AGE'
+    ASYNC_ANALYSIS = 'ASYNC_ANALYSIS'
+    ANALYSIS_TIMEOUT = 'ANALYSIS_TIMEOUT'
+    HASH_ALGORITHMS = 'HASH_ALGORITHMS'
+    MIME_HEADER_BYTES = 'MIME_HEADER_BYTES'
+    EXTRACTION_WORKERS = 'EXTRACTION_WORKERS'
+    EXTRACTION_TIMEOUT = 'EXTRACTION_TIMEOUT'
+    EXTRACTION_TIMEOUTS = 'EXTRACTION_TIMEOUTS'
+    EXTRACTION_MEMORY_LIMIT = 'EXTRACTION_MEMORY_LIMIT'
+    NATIVE_EXTRACTION = 'NATIVE_EXTRACTION'
+    NATIVE_EXTRACTION_BYTES = 'NATIVE_EXTRACTION_BYTES'
+    SPOOL_DIR = 'SPOOL_DIR'
+    SPOOL_BYTES = 'SPOOL_BYTES'
+    HASH_WORKERS = 'HASH_WORKERS'
+    HASH_CHECKPOINT_FILES = 'HASH_CHECKPOINT_FILES'
+    HASH_RUN_TIMEOUT = 'HASH_RUN_TIMEOUT'
+    KNOWN_HASH_LISTS = 'KNOWN_HASH_LISTS'
+    KNOWN_HASH_CACHE_DIR = 'KNOWN_HASH_CACHE_DIR'
+    KNOWN_FILES_SKIP_EXTRACTION = 'KNOWN_FILES_SKIP_EXTRACTION'
+    BLOB_STORE_DIR = 'BLOB_STORE_DIR'
+    BLOB_STORE_BYTES = 'BLOB_STORE_BYTES'
+    BLOB_STORE_COMPRESS = 'BLOB_STORE_COMPRESS'
+    BLOB_STORE_LEVEL = 'BLOB_STORE_LEVEL'
+    MMAP_RAW_IMAGES = 'MMAP_RAW_IMAGES'
+    CHUNK_CACHE_BYTES = 'CHUNK_CACHE_BYTES'
+    READ_AHEAD_MIN = 'READ_AHEAD_MIN'
+    READ_AHEAD_MAX = 'READ_AHEAD_MAX'
+    READ_AHEAD_PREFETCH = 'READ_AHEAD_PREFETCH'
+    LISTING_CACHE_BYTES = 'LISTING_CACHE_BYTES'
+    LISTING_PAGE_SIZE = 'LISTING_PAGE_SIZE'
+    LISTING_PAGE_MAX = 'LISTING_PAGE_MAX'
+    CATALOG_BATCH_SIZE = 'CATALOG_BATCH_SIZE'
+    CATALOG_ON_SYNCH = 'CATALOG_ON_SYNCH'
+    TREE_INDEX_BYTES = 'TREE_INDEX_BYTES'
 
 class Defaults(object):
     """Default values"""
@@ -46,6 +83,22 @@ class MimeTypes(object):
     BINARY = 'application/octet-stream'
     HTML = 'text/html'
 
+class ContentKinds(object):
+    """Kinds of content derived from an image, part of each response's ETag"""
+    META = 'meta'
+    PARTITIONS = 'partitions'
+    LISTING = 'listing'
+    CONTENT = 'content'
+    ANALYSIS = 'analysis'
+
+class AnalysisStatus(object):
+    """States of a file analysis in the analysis cache"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+    IN_PROGRESS = [QUEUED, RUNNING]
+
 class FileExtns(object):
     """Extensions for text extraction support (via textract)
     See http://textract.readthedocs.io/en/stable/ for deps to support these
@@ -98,6 +151,21 @@ class PartFlds(object):
         DESC  : Defaults.NA
     }
 
+class FileFlds(object):
+    """Database fields for the DB file entry (catalog) table"""
+    PARTITION = 'partition_id'
+    ADDR = 'addr'
+    PARENT = 'parent_addr'
+    NAME = 'name'
+    SIZE = 'size'
+    MODE = 'mode'
+    MTIME = 'mtime'
+    ATIME = 'atime'
+    CTIME = 'ctime'
+    IS_DIR = 'is_dir'
+    IS_DELETED = 'is_deleted'
+    IS_CANDIDATE = 'is_candidate'
+
 class PathChars(object):
     """File path separator characters"""
     PATH_SEP_FOR = '/'
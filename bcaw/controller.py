@@ -10,19 +10,55 @@
 # about the terms of this license.
 #
 
+import datetime
+import hashlib
 import logging
 import os
 import urllib
-from flask import Flask, render_template, send_file, send_from_directory
-from flask import Response, stream_with_context, request
-from textract import process
-from textract.exceptions import ExtensionNotSupported
+import uuid
+from collections import OrderedDict
+from flask import Flask, render_template, send_from_directory
+from flask import Response, stream_with_context, request, abort, make_response
+from flask import jsonify, redirect
 
 from bcaw import app
-from bcaw.const import ConfKey, MimeTypes
-from bcaw.disk_utils import ImageDir, ImageFile, FileSysEle
-from bcaw.model import Image, Partition
-from bcaw.utilities import identify_mime_path, sha1_path, map_mime_to_ext
+from bcaw import catalog
+from bcaw import hashing
+from bcaw.analysis import request_analysis, content_occurrences, stored_digests
+from bcaw.blob_store import BlobStore
+from bcaw.const import ConfKey, MimeTypes, ContentKinds
+from bcaw.disk_utils import ImageDir, ImageFile, FileSysEle, ImageHandlePool
+from bcaw.disk_utils import image_identity
+from bcaw.disk_utils import ListingCache, ListingPage, ReadAhead
+from bcaw.dir_tree import TreeIndexCache
+from bcaw.extraction import ExtractionPool
+from bcaw.img_readers import ChunkCache
+from bcaw.known_files import KnownAddrCache, KnownFiles
+from bcaw.model import Image, Partition, Catalog, FileAnalysis, FileHash, HashRun
+from bcaw.spool import SpoolDir
+from bcaw.utilities import parse_byte_ranges
+
+ImageHandlePool.configure(app.config[ConfKey.IMAGE_POOL_SIZE],
+                          app.config[ConfKey.MMAP_RAW_IMAGES])
+ListingCache.configure(app.config[ConfKey.LISTING_CACHE_BYTES])
+TreeIndexCache.configure(app.config[ConfKey.TREE_INDEX_BYTES])
+ChunkCache.configure(app.config[ConfKey.CHUNK_CACHE_BYTES])
+ReadAhead.configure(app.config[ConfKey.READ_AHEAD_MIN],
+                    app.config[ConfKey.READ_AHEAD_MAX],
+                    app.config[ConfKey.READ_AHEAD_PREFETCH])
+ExtractionPool.configure(app.config[ConfKey.EXTRACTION_WORKERS],
+                         app.config[ConfKey.EXTRACTION_TIMEOUT],
+                         app.config[ConfKey.EXTRACTION_TIMEOUTS],
+                         app.config[ConfKey.EXTRACTION_MEMORY_LIMIT],
+                         app.config[ConfKey.NATIVE_EXTRACTION],
+                         app.config[ConfKey.NATIVE_EXTRACTION_BYTES])
+SpoolDir.configure(app.config[ConfKey.SPOOL_DIR], app.config[ConfKey.SPOOL_BYTES])
+KnownFiles.configure(app.config[ConfKey.KNOWN_HASH_LISTS],
+                     cache_dir=app.config[ConfKey.KNOWN_HASH_CACHE_DIR])
+BlobStore.configure(app.config[ConfKey.BLOB_STORE_DIR],
+                    app.config[ConfKey.BLOB_STORE_BYTES],
+                    app.config[ConfKey.BLOB_STORE_COMPRESS],
+                    app.config[ConfKey.BLOB_STORE_LEVEL])
 
 @app.route('/')
 def bcaw_home():
@@ -38,23 +74,56 @@ def bcaw_home():
 def image_meta(image_id):
     """Image metadata page, retrieves image info from DB and displays it."""
     image = Image.byId(image_id)
-    return render_template('image.html', image=image)
+    validators = content_validators(image, ContentKinds.META)
+    if is_not_modified(validators):
+        return not_modified(validators)
+    return add_validators(make_response(render_template('image.html', image=image)),
+                          validators)
 
 @app.route('/image/data/<image_id>/')
 def image_dnld(image_id):
-    """Image download request, returns the image binary"""
+    """Image download request, returns the image binary. If configured the
+    transfer is handed to nginx via X-Accel-Redirect once the image has been
+    looked up, nginx then sends the file itself with range support."""
     image = Image.byId(image_id)
+    if app.config[ConfKey.IMAGE_ACCEL_REDIRECT]:
+        response = Response(mimetype=MimeTypes.BINARY)
+        response.headers['X-Accel-Redirect'] = app.config[ConfKey.IMAGE_ACCEL_PREFIX] + \
+                                               quote_utf8(image.name)
+        response.headers['Content-Disposition'] = content_disposition(image.name)
+        return response
     parent = os.path.abspath(os.path.join(image.path, os.pardir))
-    return send_from_directory(parent, image.name, as_attachment=True)
+    return send_from_directory(parent, image.name, as_attachment=True,
+                               conditional=True)
 
 @app.route('/image/<image_id>/')
 def image_parts(image_id):
     """Page listing the partition details for on image, retrieved from DB."""
     image = Image.byId(image_id)
+    # The page shows the state of each partition's catalog
+    catalogs = dict((part.id, Catalog.byPartId(part.id)) for part in image.getPartitions())
+    validators = content_validators(image, ContentKinds.PARTITIONS,
+                                    sorted((part_id, part_catalog.complete, part_catalog.entries)
+                                           for part_id, part_catalog in catalogs.items()
+                                           if part_catalog is not None))
+    if is_not_modified(validators):
+        return not_modified(validators)
     logging.debug("Getting parts for image: " + image.name)
     for part in image.partitions.all():
         logging.debug("Part " + str(part.id))
-    return render_template('partitions.html', image=image, partitions=image.getPartitions())
+    return add_validators(make_response(render_template('partitions.html', image=image,
+                                                        partitions=image.getPartitions(),
+                                                        catalogs=catalogs)),
+                          validators)
+
+@app.route('/image/<image_id>/<part_id>/catalog/', methods=['POST'])
+def build_part_catalog(image_id, part_id):
+    """Queues a background build of the partition's file system catalog,
+    replacing any existing catalog once it's complete."""
+    image = Image.byId(image_id)
+    image_part = Partition.byId(part_id)
+    catalog.queue_catalog_build(image_part.id)
+    return redirect('/image/%d/' % image.id, code=303)
 
 @app.route('/image/<image_id>/<part_id>/')
 def part_root(image_id, part_id):
@@ -73,42 +142,316 @@ def file_handler(image_id, part_id, encoded_filepath):
     file_path = urllib.unquote(encoded_filepath)
     image = Image.byId(image_id)
     image_part = Partition.byId(part_id)
-    fs_ele = FileSysEle.fromImagePath(image.path, image_part, image.bps, file_path)
+    part_catalog = Catalog.completeForPartId(image_part.id)
+    if part_catalog is not None:
+        fs_ele = catalog.resolve_path(part_catalog, file_path)
+    else:
+        fs_ele = FileSysEle.fromImagePath(image.path, image_part, image.bps, file_path)
+    if fs_ele is None:
+        abort(404)
+    return fs_ele_response(image, image_part, fs_ele, file_path, part_catalog,
+                           path_resolved=True)
+
+@app.route('/image/<image_id>/<part_id>/inode/<int:addr>/')
+def inode_handler(image_id, part_id, addr):
+    """Display page for a file system element addressed by its meta address,
+    avoiding a walk of the element's path. The optional path request parameter
+    is the human readable path used for display only.
+    """
+    file_path = request.args.get('path', '/')
+    image = Image.byId(image_id)
+    image_part = Partition.byId(part_id)
+    part_catalog = Catalog.completeForPartId(image_part.id)
+    if part_catalog is not None:
+        fs_ele = catalog.element_by_addr(part_catalog, addr, file_path)
+        if fs_ele is None:
+            abort(404)
+        return fs_ele_response(image, image_part, fs_ele, file_path, part_catalog)
+    try:
+        fs_ele = FileSysEle.fromImageInode(image.path, image_part, image.bps,
+                                           addr, file_path)
+    except IOError:
+        logging.exception("Failed to open inode %d in image %s", addr, image.path)
+        abort(404)
+    return fs_ele_response(image, image_part, fs_ele, file_path)
+
+def fs_ele_response(image, image_part, fs_ele, file_path, part_catalog=None,
+                    path_resolved=False):
+    """Returns the response for a resolved file system element, a directory
+    listing, a binary payload or the file analysis page. Listings come from the
+    partition's catalog when one is supplied. path_resolved is set if the
+    element was found by its path rather than file_path only being for display."""
     # Check if we have a directory
     if fs_ele.isDirectory():
-        # Render the dir listing template
-        files = FileSysEle.listFiles(image.path, image_part, image.bps, file_path)
-        return render_template('directory.html', image=image,
-                               partition=image_part, files=files)
-    # Its a file, do we want details or binary
-    temp_file = FileSysEle.createTempCopy(image.path,
-                                          image_part.start,
-                                          image.bps, fs_ele)
-    # Is this a blob request
-    if request_wants_binary():
-        return send_file(temp_file, mime_type=FileSysEle.GuessMimeType(fs_ele.name),
-                         as_attachment=True, attachment_filename=fs_ele.name)
-
-    mime_type = identify_mime_path(temp_file)
-    sha1 = sha1_path(temp_file)
-    logging.debug("MIME: %s SHA1:%s", mime_type, sha1)
-    extension = map_mime_to_ext(mime_type)
-    full_text = "N/A"
-    if extension is not None:
-        try:
-            logging.debug("Textract for doc %s, extension map val %s", file_path, extension)
-            full_text = process(temp_file, extension=extension, encoding='ascii')
-        except ExtensionNotSupported as _:
-            logging.exception("Textract extension not supported for ext %s", extension)
-            logging.debug("Temp path for file is %s", temp_file)
-            full_text = "N/A"
-        except:
-            logging.exception("Textract unexpectedly failed for temp_file %s", temp_file)
-            raise
-
-    return render_template('analysis.html', image=image, partition=image_part,
-                           file_path=file_path, fs_ele=fs_ele, mime_type=mime_type,
-                           sha1=sha1, full_text=full_text)
+        # Known files are those a hashing run of the partition found, listing
+        # pages vary with them and the pagination and sort parameters
+        run = HashRun.byPartId(image_part.id) if KnownFiles.isEnabled() else None
+        run_version = (run.updated, run.files) if run is not None else None
+        validators = content_validators(image, ContentKinds.LISTING, image_part.id,
+                                        fs_ele.addr, request.query_string, run_version,
+                                        part_catalog is not None)
+        if is_not_modified(validators):
+            return not_modified(validators)
+        known = KnownAddrCache.get(image_part.id, run_version,
+                                   lambda: FileHash.knownAddrsForPartId(image_part.id)) \
+                if run is not None else ()
+        # Render the dir listing template, the root element has no address
+        # so is listed by path. Catalogued directories know their entry count.
+        total = None
+        if part_catalog is not None:
+            files = catalog.list_directory(part_catalog, fs_ele.addr, file_path)
+            total = catalog.count_directory(part_catalog, fs_ele.addr)
+        elif fs_ele.addr < 0:
+            files = FileSysEle.listFiles(image.path, image_part, image.bps, file_path)
+        else:
+            files = FileSysEle.listFilesByInode(image.path, image_part, image.bps,
+                                                fs_ele.addr, file_path)
+        if known and request.args.get('known') == 'hide':
+            files = (listed for listed in files if listed.addr not in known)
+        limit = request.args.get('limit', app.config[ConfKey.LISTING_PAGE_SIZE], type=int)
+        page = ListingPage(files,
+                           offset=request.args.get('offset', 0, type=int),
+                           limit=min(max(1, limit), app.config[ConfKey.LISTING_PAGE_MAX]),
+                           sort_by=request.args.get('sort'),
+                           reverse=request.args.get('order') == 'desc')
+        # Stream the listing so the first rows reach the browser immediately
+        return add_validators(Response(stream_with_context(
+            stream_template('directory.html', image=image, partition=image_part,
+                            page=page, total=total, known=known,
+                            listing_url=listing_url))), validators)
+    # Its a file, blob and byte range requests are streamed from the image
+    if 'Range' in request.headers or request_wants_binary():
+        validators = content_validators(image, ContentKinds.CONTENT, image_part.id,
+                                        fs_ele.addr)
+        if is_not_modified(validators):
+            return not_modified(validators, app.config[ConfKey.CONTENT_MAX_AGE])
+        return add_validators(payload_response(image, image_part, fs_ele, validators[0]),
+                              validators, app.config[ConfKey.CONTENT_MAX_AGE])
+    # Analysis results come from the analysis cache where possible, otherwise
+    # the page polls for the results of a queued analysis
+    analysis = request_analysis(image, image_part, fs_ele,
+                                file_path if path_resolved else None)
+    if not analysis.isComplete():
+        return render_template('analysis.html', image=image, partition=image_part,
+                               file_path=file_path, fs_ele=fs_ele,
+                               mime_type=analysis.mime_type, analysis=analysis)
+    # The page lists the other copies of the content, so varies as they're found
+    occurrences = content_occurrences(analysis)
+    validators = content_validators(image, ContentKinds.ANALYSIS, image_part.id,
+                                    fs_ele.addr, file_path,
+                                    [(part.id, addr) for _, part, addr, _ in occurrences])
+    if is_not_modified(validators):
+        return not_modified(validators)
+    full_text = analysis.getFullText()
+    return add_validators(make_response(render_template(
+        'analysis.html', image=image, partition=image_part, file_path=file_path,
+        fs_ele=fs_ele, mime_type=analysis.mime_type, sha1=analysis.sha1,
+        full_text=full_text if full_text is not None else "N/A",
+        analysis=analysis, occurrences=occurrences)), validators)
+
+@app.route('/image/<image_id>/<part_id>/hashes/', methods=['GET', 'POST'])
+def partition_hashes(image_id, part_id):
+    """Partition hashing page, showing the progress and worker throughput of
+    the partition's hashing run with links to its manifests. Posting starts a
+    background run, resuming an interrupted or stale one."""
+    image = Image.byId(image_id)
+    image_part = Partition.byId(part_id)
+    if request.method == 'POST':
+        hashing.queue_partition_hashing(image_part.id)
+        return redirect(request.path, code=303)
+    run = HashRun.byPartId(image_part.id)
+    return render_template('hashes.html', image=image, partition=image_part,
+                           run=run, stale=run is not None and hashing.is_stale(run))
+
+@app.route('/image/<image_id>/<part_id>/hashes/manifest.csv')
+def hash_manifest_csv(image_id, part_id):
+    """CSV manifest of the file hashes stored for a partition."""
+    image = Image.byId(image_id)
+    image_part = Partition.byId(part_id)
+    return manifest_response(hashing.manifest_csv(image_part.id), 'text/csv',
+                             '%s-%d-hashes.csv' % (image.name, image_part.id))
+
+@app.route('/image/<image_id>/<part_id>/hashes/manifest.xml')
+def hash_manifest_dfxml(image_id, part_id):
+    """DFXML manifest of the file hashes stored for a partition."""
+    image = Image.byId(image_id)
+    image_part = Partition.byId(part_id)
+    return manifest_response(hashing.manifest_dfxml(image, image_part),
+                             'application/xml',
+                             '%s-%d-hashes.xml' % (image.name, image_part.id))
+
+def manifest_response(lines, mime_type, file_name):
+    """Streams a manifest's lines as an attachment named file_name."""
+    response = Response(stream_with_context(lines), mimetype=mime_type)
+    response.headers['Content-Disposition'] = content_disposition(file_name)
+    return response
+
+@app.route('/image/<image_id>/<part_id>/analysis/<int:addr>/')
+def analysis_status(image_id, part_id, addr):
+    """JSON status and results of a file's analysis, polled by the analysis
+    page while text extraction runs in the background."""
+    image_part = Partition.byId(part_id)
+    analysis = FileAnalysis.byAddr(image_part.id, addr)
+    if analysis is None:
+        abort(404)
+    return jsonify(analysis.toStatusMap())
+
+def payload_response(image, image_part, fs_ele, etag=None):
+    """Returns a response streaming a file's content directly from the image,
+    with no temp copy, or from the BlobStore if it holds the whole content. If the
+    request has a Range header the response is 206 partial content, a single
+    range is sent as is and multiple ranges as multipart/byteranges. The Range
+    header is ignored if an If-Range header doesn't match etag.
+    """
+    size = fs_ele.size
+    sha1 = None
+    if BlobStore.isEnabled():
+        sha1 = (stored_digests(image_part.id, fs_ele.addr) or {}).get('sha1')
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if if_range is not None and if_range.strip('"') != etag:
+        range_header = None
+    ranges = parse_byte_ranges(range_header, size)
+    if ranges is None:
+        response = Response(status=416)
+        response.headers['Content-Range'] = 'bytes */%d' % size
+        return response
+    mime_type = FileSysEle.GuessMimeType(fs_ele.name) or MimeTypes.BINARY
+    if len(ranges) <= 1:
+        # No or an invalid Range header, the whole file is sent
+        start, end = ranges[0] if ranges else (0, size)
+        payload = content_chunks(image, image_part, fs_ele, sha1, start, end - start)
+        response = Response(stream_with_context(payload),
+                            status=206 if ranges else 200,
+                            mimetype=mime_type, direct_passthrough=True)
+        if ranges:
+            response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
+        response.headers['Content-Length'] = end - start
+    else:
+        boundary = uuid.uuid4().hex
+        parts = [('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' %
+                  (boundary, mime_type, start, end - 1, size), start, end)
+                 for start, end in ranges]
+        closing = '\r\n--%s--\r\n' % boundary
+
+        def multipart():
+            for header, start, end in parts:
+                yield header
+                for data in content_chunks(image, image_part, fs_ele, sha1, start,
+                                           end - start):
+                    yield data
+            yield closing
+
+        response = Response(stream_with_context(multipart()), status=206,
+                            mimetype='multipart/byteranges; boundary=' + boundary,
+                            direct_passthrough=True)
+        response.headers['Content-Length'] = sum(len(header) + end - start
+                                                 for header, start, end in parts) + \
+                                             len(closing)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Disposition'] = content_disposition(fs_ele.name)
+    return response
+
+def content_chunks(image, image_part, fs_ele, sha1, start, length):
+    """Returns a generator of length bytes of a file's content from start,
+    read from the BlobStore if it holds the content with digest sha1,
+    otherwise from the image. Only whole files are read from the BlobStore,
+    as the content is checked against sha1 while it's sent."""
+    whole_file = start == 0 and length == fs_ele.size
+    blob = BlobStore.open(sha1) if sha1 and whole_file else None
+    if blob is not None:
+        return BlobStore.verifiedChunks(sha1, blob, length)
+    return FileSysEle.payloadGenerator(image.path, image_part.start, image.bps,
+                                       fs_ele, start, length)
+
+def content_disposition(file_name):
+    """Returns an attachment Content-Disposition header value for file_name."""
+    return "attachment; filename*=UTF-8''" + quote_utf8(file_name)
+
+def quote_utf8(name):
+    """URL quotes name, UTF-8 encoding it first if needed."""
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return urllib.quote(name)
+
+def content_validators(image, kind, *key):
+    """Returns the (etag, last modified) validators for content of the given
+    kind derived from image, further identified by key, e.g. partition id
+    and meta address. Images are immutable evidence so the strong ETag is
+    derived from the image's identity rather than the content itself. Only
+    file content has a last modified time, the image's, other kinds depend on
+    database state the key accounts for so their last modified is None.
+    """
+    identity = image_identity(image.path)
+    etag = hashlib.sha1(repr((identity, kind) + key)).hexdigest()
+    if kind != ContentKinds.CONTENT:
+        return etag, None
+    return etag, datetime.datetime.utcfromtimestamp(identity[2])
+
+def is_not_modified(validators):
+    """Checks the request's If-None-Match, or If-Modified-Since if there's no
+    If-None-Match, against the validators."""
+    etag, last_modified = validators
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    modified_since = request.if_modified_since
+    if modified_since is not None and last_modified is not None:
+        return last_modified <= modified_since.replace(tzinfo=None)
+    return False
+
+def not_modified(validators, max_age=None):
+    """Returns a 304 not modified response carrying the validators."""
+    return add_validators(Response(status=304), validators, max_age)
+
+def add_validators(response, validators, max_age=None):
+    """Sets the ETag, Last-Modified, if any, and Cache-Control headers of response.
+    With a max_age the response can be cached without revalidation, without
+    one caches must revalidate, usually getting a 304.
+    """
+    etag, last_modified = validators
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if max_age:
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % max_age
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/admin/')
+def admin():
+    """Admin page showing this process's cache and performance metrics."""
+    return render_template('admin.html', metrics=process_metrics())
+
+def process_metrics():
+    """Returns the metrics dictionaries of this process's caches and pools,
+    keyed by display name."""
+    return OrderedDict([
+        ('Image Handle Pool', ImageHandlePool.stats()),
+        ('Image Chunk Cache', ChunkCache.stats()),
+        ('Content Read Ahead', ReadAhead.stats()),
+        ('Directory Listing Cache', ListingCache.stats()),
+        ('Directory Tree Index', TreeIndexCache.stats()),
+        ('Text Extraction Pool', ExtractionPool.stats()),
+        ('Extraction Spool', SpoolDir.stats()),
+        ('Known Files', KnownFiles.stats()),
+        ('Content Blob Store', BlobStore.stats())
+    ])
+
+def stream_template(template_name, **context):
+    """Renders a template as a stream of chunks rather than a single string."""
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(20)
+    return stream
+
+def listing_url(**changes):
+    """Returns the current request URL with the query parameters in changes
+    replaced, used for listing pagination and sort links."""
+    args = dict((key, value.encode('utf-8')) for key, value in request.args.items())
+    args.update(changes)
+    return request.path + '?' + urllib.urlencode(args)
 
 def request_wants_binary():
     """Checks the accepts MIME type of the incoming request and returns True
@@ -149,7 +492,10 @@ class DbSynch(object):
             Image.addImage(model_image)
             ImageFile.populateParts(image)
             for part in image.getPartitions():
-                Partition.addPart(Partition(**part.toPartDbMap(model_image.id)))
+                model_part = Partition(**part.toPartDbMap(model_image.id))
+                Partition.addPart(model_part)
+                if app.config[ConfKey.CATALOG_ON_SYNCH] and model_part.slot >= 0:
+                    catalog.queue_catalog_build(model_part.id)
 
         for image in cls.__not_on_disk__:
             logging.warn("Image: " + image.path + " appears to have been deleted from disk.")
@@ -0,0 +1,329 @@
+#!/usr/bin/python
+# coding=UTF-8
+#
+# BitCurator Access Webtools (Disk Image Access for the Web)
+# Copyright (C) 2014 - 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""Compact in-memory directory tree index for disk image partitions."""
+import logging
+import threading
+from array import array
+from collections import OrderedDict, namedtuple
+
+from const import FileFlds
+
+# Read only view of a tree entry, shares attribute names with the DB file
+# entry so both can be turned into a FileSysEle the same way
+TreeEntry = namedtuple('TreeEntry', ['addr', 'parent_addr', 'name', 'size', 'mode',
+                                     'mtime', 'atime', 'ctime', 'is_dir',
+                                     'is_deleted', 'is_candidate'])
+
+class Flags(object):
+    """Bit flags packed into a single byte per entry."""
+    DIR = 0x01
+    DELETED = 0x02
+    CANDIDATE = 0x04
+
+class DirTree(object):
+    """Directory tree for one partition held in parallel arrays rather than
+    an object per file. Entries are sorted by parent meta address then name,
+    each directory's children are a contiguous range of the arrays and names
+    are offsets into a single UTF-8 blob. Child enumeration is O(k) for k
+    children, each path component and meta address lookup is a binary search.
+    DOCTESTS:
+    >>> tree = DirTree(5, [
+    ...     {'addr': 12, 'parent_addr': 5, 'name': u'docs', 'size': 0, 'mode': 0,
+    ...      'mtime': 0, 'atime': 0, 'ctime': 0, 'is_dir': True,
+    ...      'is_deleted': False, 'is_candidate': False},
+    ...     {'addr': 14, 'parent_addr': 12, 'name': u'b.pdf', 'size': 20, 'mode': 0,
+    ...      'mtime': 0, 'atime': 0, 'ctime': 0, 'is_dir': False,
+    ...      'is_deleted': False, 'is_candidate': True},
+    ...     {'addr': 13, 'parent_addr': 12, 'name': u'a.txt', 'size': 10, 'mode': 0,
+    ...      'mtime': 0, 'atime': 0, 'ctime': 0, 'is_dir': False,
+    ...      'is_deleted': True, 'is_candidate': True}])
+    >>> len(tree)
+    3
+    >>> [entry.name for entry in tree.children(12)]
+    [u'a.txt', u'b.pdf']
+    >>> tree.byPath('/docs/b.pdf').addr
+    14
+    >>> tree.byPath('/docs/c.pdf') is None
+    True
+    >>> tree.addrForPath('/')
+    5
+    >>> tree.byAddr(13).is_deleted
+    True
+    >>> tree.pathForAddr(14)
+    u'/docs/b.pdf'
+    >>> tree.pathForAddr(99) is None
+    True
+    """
+    def __init__(self, root_addr, entries):
+        self.root_addr = root_addr
+        # Fill unsorted arrays then permute them, sorting indexes rather
+        # than a tuple per entry
+        parents = array('l')
+        addrs = array('l')
+        sizes = array('l')
+        modes = array('I')
+        mtimes = array('l')
+        atimes = array('l')
+        ctimes = array('l')
+        flags = array('B')
+        names = []
+        for entry in entries:
+            parents.append(entry[FileFlds.PARENT])
+            addrs.append(entry[FileFlds.ADDR])
+            sizes.append(entry[FileFlds.SIZE])
+            modes.append(int(entry[FileFlds.MODE]))
+            mtimes.append(entry[FileFlds.MTIME])
+            atimes.append(entry[FileFlds.ATIME])
+            ctimes.append(entry[FileFlds.CTIME])
+            flags.append(pack_flags(entry))
+            names.append(entry[FileFlds.NAME].encode('utf-8'))
+        # Stable sorts, by name then parent, order by parent then name
+        order = sorted(xrange(len(names)), key=names.__getitem__)
+        order.sort(key=parents.__getitem__)
+        order = array('L', order)
+        self._parents = _permuted(parents, order)
+        self._addrs = _permuted(addrs, order)
+        self._sizes = _permuted(sizes, order)
+        self._modes = _permuted(modes, order)
+        self._mtimes = _permuted(mtimes, order)
+        self._atimes = _permuted(atimes, order)
+        self._ctimes = _permuted(ctimes, order)
+        self._flags = _permuted(flags, order)
+        del parents, addrs, sizes, modes, mtimes, atimes, ctimes, flags
+        self._name_offsets = array('L', [0])
+        offset = 0
+        for index in order:
+            offset += len(names[index])
+            self._name_offsets.append(offset)
+        self._names = b''.join([names[index] for index in order])
+        del names, order
+        # Index of entries sorted by meta address for byAddr lookups
+        self._by_addr = array('L', sorted(xrange(len(self._addrs)),
+                                          key=self._addrs.__getitem__))
+
+    def __len__(self):
+        return len(self._addrs)
+
+    def memorySize(self):
+        """Returns the bytes held by the tree's arrays and name blob."""
+        arrays = [self._parents, self._addrs, self._sizes, self._modes,
+                  self._mtimes, self._atimes, self._ctimes, self._flags,
+                  self._name_offsets, self._by_addr]
+        return len(self._names) + sum(len(arr) * arr.itemsize for arr in arrays)
+
+    def children(self, dir_addr):
+        """Generator yielding the entries of the directory with meta address
+        dir_addr."""
+        start, end = self._childRange(dir_addr)
+        for index in xrange(start, end):
+            yield self.entry(index)
+
+    def byPath(self, path):
+        """Returns the entry at path, None for the root or a missing path."""
+        index = None
+        dir_addr = self.root_addr
+        for name in [name for name in path.split('/') if name]:
+            index = self._findChild(dir_addr, name.encode('utf-8') \
+                                    if isinstance(name, unicode) else name)
+            if index is None:
+                return None
+            dir_addr = self._addrs[index]
+        return None if index is None else self.entry(index)
+
+    def addrForPath(self, path):
+        """Returns the meta address of the element at path, or None."""
+        if not path.strip('/'):
+            return self.root_addr
+        entry = self.byPath(path)
+        return None if entry is None else entry.addr
+
+    def byAddr(self, addr):
+        """Returns an entry with meta address addr, or None."""
+        low = self._bisectAddr(addr)
+        if low < len(self._by_addr) and self._addrs[self._by_addr[low]] == addr:
+            return self.entry(self._by_addr[low])
+        return None
+
+    def pathForAddr(self, addr):
+        """Returns the path of the element with meta address addr, following
+        its parent directories to the root, or None if it isn't in the tree."""
+        names = []
+        seen = set()
+        while addr != self.root_addr:
+            index = self._namedIndex(addr)
+            if index is None or addr in seen:
+                return None
+            seen.add(addr)
+            names.append(self._name(index).decode('utf-8'))
+            addr = self._parents[index]
+        return u'/' + u'/'.join(reversed(names))
+
+    def entry(self, index):
+        """Returns the TreeEntry view of the entry at index."""
+        flags = self._flags[index]
+        return TreeEntry(self._addrs[index], self._parents[index],
+                         self._name(index).decode('utf-8'), self._sizes[index],
+                         self._modes[index], self._mtimes[index],
+                         self._atimes[index], self._ctimes[index],
+                         bool(flags & Flags.DIR), bool(flags & Flags.DELETED),
+                         bool(flags & Flags.CANDIDATE))
+
+    def _name(self, index):
+        return self._names[self._name_offsets[index]:self._name_offsets[index + 1]]
+
+    def _bisectAddr(self, addr):
+        """Returns the position of the first entry for addr in _by_addr."""
+        low, high = 0, len(self._by_addr)
+        while low < high:
+            mid = (low + high) // 2
+            if self._addrs[self._by_addr[mid]] < addr:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _namedIndex(self, addr):
+        """Returns the index of an entry for addr other than a . or .. entry."""
+        for position in xrange(self._bisectAddr(addr), len(self._by_addr)):
+            index = self._by_addr[position]
+            if self._addrs[index] != addr:
+                break
+            if self._name(index) not in (b'.', b'..'):
+                return index
+        return None
+
+    def _childRange(self, dir_addr):
+        """Returns the start and end indexes of a directory's children."""
+        return (self._bisectParent(dir_addr, False),
+                self._bisectParent(dir_addr, True))
+
+    def _bisectParent(self, dir_addr, right):
+        low, high = 0, len(self._parents)
+        while low < high:
+            mid = (low + high) // 2
+            parent = self._parents[mid]
+            if parent < dir_addr or (right and parent == dir_addr):
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _findChild(self, dir_addr, name):
+        """Binary searches a directory's name sorted children for name."""
+        low, end = self._childRange(dir_addr)
+        high = end
+        while low < high:
+            mid = (low + high) // 2
+            if self._name(mid) < name:
+                low = mid + 1
+            else:
+                high = mid
+        if low < end and self._name(low) == name:
+            return low
+        return None
+
+class TreeIndexCache(object):
+    """Per-process registry of partition DirTrees, built on first access and
+    evicted least recently used first when their combined size exceeds the
+    memory budget. A budget of 0 disables the tree index.
+    """
+    max_bytes = 0
+    current_bytes = 0
+    __trees__ = OrderedDict()
+    __oversized__ = set()
+    __building__ = {}
+    __lock__ = threading.RLock()
+
+    @classmethod
+    def configure(cls, max_bytes):
+        """Sets the memory budget in bytes, evicting as needed."""
+        with cls.__lock__:
+            cls.max_bytes = max(0, int(max_bytes))
+            cls.__oversized__.clear()
+            cls._evict()
+
+    @classmethod
+    def isEnabled(cls):
+        return cls.max_bytes > 0
+
+    @classmethod
+    def get(cls, key, builder):
+        """Returns the tree for key, calling builder to create it if needed.
+        Returns None if the index is disabled or the tree is over budget, over
+        budget keys aren't rebuilt.
+        """
+        if not cls.isEnabled():
+            return None
+        while True:
+            with cls.__lock__:
+                if key in cls.__oversized__:
+                    return None
+                tree = cls.__trees__.pop(key, None)
+                if tree is not None:
+                    cls.__trees__[key] = tree
+                    return tree
+                built = cls.__building__.get(key)
+                if built is None:
+                    # This thread builds the tree, others for it wait
+                    built = cls.__building__[key] = threading.Event()
+                    break
+            built.wait()
+        try:
+            # Built outside the lock so other partitions' lookups carry on
+            tree = builder()
+            size = tree.memorySize()
+            logging.info("Built tree index of %d entries, %d bytes for %s",
+                         len(tree), size, str(key))
+            with cls.__lock__:
+                if size > cls.max_bytes:
+                    cls.__oversized__.add(key)
+                    return None
+                cls.__trees__[key] = tree
+                cls.current_bytes += size
+                cls._evict()
+                return tree
+        finally:
+            with cls.__lock__:
+                del cls.__building__[key]
+            built.set()
+
+    @classmethod
+    def stats(cls):
+        """Returns a dictionary describing resident trees and memory use."""
+        return {
+            'trees': len(cls.__trees__),
+            'entries': sum(len(tree) for tree in cls.__trees__.values()),
+            'bytes': cls.current_bytes,
+            'max_bytes': cls.max_bytes
+        }
+
+    @classmethod
+    def _evict(cls):
+        while cls.__trees__ and cls.current_bytes > cls.max_bytes:
+            key, tree = cls.__trees__.popitem(last=False)
+            logging.debug("Evicting tree index for %s", str(key))
+            cls.current_bytes -= tree.memorySize()
+
+def _permuted(values, order):
+    """Returns a copy of the array values in the index order order."""
+    return array(values.typecode, (values[index] for index in order))
+
+def pack_flags(entry):
+    """Packs an entry map's boolean fields into a flags byte.
+    DOCTESTS:
+    >>> pack_flags({'is_dir': True, 'is_deleted': False, 'is_candidate': True})
+    5
+    """
+    flags = Flags.DIR if entry[FileFlds.IS_DIR] else 0
+    flags |= Flags.DELETED if entry[FileFlds.IS_DELETED] else 0
+    flags |= Flags.CANDIDATE if entry[FileFlds.IS_CANDIDATE] else 0
+    return flags
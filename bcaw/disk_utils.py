@@ -18,16 +18,207 @@ import logging
 import os
 import ntpath
 import datetime
+import heapq
+import itertools
+import Queue
 import subprocess
-import tempfile
+import sys
+import threading
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from mimetypes import MimeTypes
 import xml.etree.ElementTree as ET
 import pytsk3
 import textract
 
 from const import Extns, ImgFlds, ExcepMess, EwfTags, EwfTagMap
-from const import PartFlds, Defaults, FileExtns, PathChars
+from const import PartFlds, Defaults, FileExtns, PathChars, FileFlds
+from dir_tree import DirTree, TreeIndexCache
+from img_readers import open_image
+from spool import SpoolDir
+
+
+class ImageHandlePool(object):
+    """Per-process pool of open pytsk3 image and file system handles.
+    Opening an image means libtsk (and libewf for E01s) re-reading segment
+    tables and superblocks so handles are kept open and shared, keyed by image
+    path and partition offset. The least recently used image is closed when
+    more than max_open images are held, each image pins at least one file
+    descriptor. Handles are dropped if the image file's size or mtime change.
+    """
+    max_open = 8
+    use_mmap = True
+    __images__ = OrderedDict()
+    __file_systems__ = {}
+    __lock__ = threading.RLock()
+
+    @classmethod
+    def configure(cls, max_open, use_mmap=True):
+        """Sets the maximum number of images held open, evicting as needed, and
+        whether raw images are memory mapped."""
+        with cls.__lock__:
+            cls.max_open = max(1, int(max_open))
+            cls.use_mmap = use_mmap
+            cls._evict()
+
+    @classmethod
+    def getImageInfo(cls, image_path):
+        """Borrow the pooled pytsk3.Img_Info for image_path."""
+        with cls.__lock__:
+            identity = image_identity(image_path)
+            entry = cls.__images__.pop(image_path, None)
+            if entry is not None and entry[0] != identity:
+                logging.info("Image " + image_path + " changed on disk, reopening.")
+                cls._close(image_path)
+                entry = None
+            if entry is None:
+                logging.debug("Opening pooled image handle for: " + image_path)
+                entry = (identity, cls._openImage(image_path, identity))
+            cls.__images__[image_path] = entry
+            cls._evict()
+            return entry[1]
+
+    @classmethod
+    def getFileSystemInfo(cls, image_path, offset):
+        """Borrow the pooled pytsk3.FS_Info for the file system found at byte
+        offset in the image at image_path.
+        """
+        with cls.__lock__:
+            image_info = cls.getImageInfo(image_path)
+            key = (image_path, offset)
+            fs_info = cls.__file_systems__.get(key)
+            if fs_info is None:
+                logging.debug("Opening pooled file system handle for: " +
+                              image_path + " offset:" + str(offset))
+                fs_info = pytsk3.FS_Info(image_info, offset=offset)
+                cls.__file_systems__[key] = fs_info
+            return fs_info
+
+    @classmethod
+    def invalidate(cls, image_path=None):
+        """Closes the handles for image_path, or all handles if no path given."""
+        with cls.__lock__:
+            paths = [image_path] if image_path else list(cls.__images__.keys())
+            for path in paths:
+                cls.__images__.pop(path, None)
+                cls._close(path)
+
+    @classmethod
+    def openCount(cls):
+        """Returns the number of images currently held open."""
+        return len(cls.__images__)
+
+    @classmethod
+    def stats(cls):
+        """Returns a dictionary describing the pool."""
+        return {
+            'open_images': len(cls.__images__),
+            'open_file_systems': len(cls.__file_systems__),
+            'max_open': cls.max_open
+        }
+
+    @classmethod
+    def _openImage(cls, image_path, identity):
+        return open_image(image_path, cls.use_mmap, identity)
+
+    @classmethod
+    def _evict(cls):
+        while len(cls.__images__) > cls.max_open:
+            path, _ = cls.__images__.popitem(last=False)
+            logging.debug("Evicting pooled image handle for: " + path)
+            cls._close(path)
+
+    @classmethod
+    def _close(cls, image_path):
+        """Drops the file system handles for image_path, pytsk3 closes the
+        underlying image once the last reference has gone."""
+        for key in [key for key in cls.__file_systems__ if key[0] == image_path]:
+            del cls.__file_systems__[key]
+
+
+class ListingCache(object):
+    """Per-process LRU cache of directory listings read from disk images.
+    Listings are keyed by image identity, partition offset and directory meta
+    address, evidence images don't change so cached listings are only dropped
+    to stay inside the memory budget or when the image's identity changes.
+    """
+    max_bytes = 64 * 1024 * 1024
+    current_bytes = 0
+    hits = 0
+    misses = 0
+    __listings__ = OrderedDict()
+    __lock__ = threading.RLock()
+
+    @classmethod
+    def configure(cls, max_bytes):
+        """Sets the memory budget in bytes, 0 disables caching."""
+        with cls.__lock__:
+            cls.max_bytes = max(0, int(max_bytes))
+            cls._evict()
+
+    @classmethod
+    def get(cls, key):
+        """Returns the cached listing for key or None, counting hits and misses."""
+        with cls.__lock__:
+            entry = cls.__listings__.pop(key, None)
+            if entry is None:
+                cls.misses += 1
+                return None
+            cls.__listings__[key] = entry
+            cls.hits += 1
+            return entry[1]
+
+    @classmethod
+    def put(cls, key, files):
+        """Caches the listing files under key if it fits the memory budget."""
+        size = sum(ele.memorySize() for ele in files) + sys.getsizeof(files)
+        if size > cls.max_bytes:
+            return
+        with cls.__lock__:
+            cls._remove(key)
+            cls._purgeStale(key[0])
+            cls.__listings__[key] = (size, files)
+            cls.current_bytes += size
+            cls._evict()
+
+    @classmethod
+    def invalidate(cls, image_path=None):
+        """Drops listings for image_path, or all listings if no path given."""
+        with cls.__lock__:
+            for key in list(cls.__listings__.keys()):
+                if image_path is None or key[0][0] == image_path:
+                    cls._remove(key)
+
+    @classmethod
+    def stats(cls):
+        """Returns a dictionary of cache counters."""
+        return {
+            'entries': len(cls.__listings__),
+            'bytes': cls.current_bytes,
+            'max_bytes': cls.max_bytes,
+            'hits': cls.hits,
+            'misses': cls.misses
+        }
+
+    @classmethod
+    def _purgeStale(cls, identity):
+        """Removes listings from earlier identities of the same image path."""
+        for key in list(cls.__listings__.keys()):
+            if key[0][0] == identity[0] and key[0] != identity:
+                cls._remove(key)
+
+    @classmethod
+    def _remove(cls, key):
+        entry = cls.__listings__.pop(key, None)
+        if entry is not None:
+            cls.current_bytes -= entry[0]
+
+    @classmethod
+    def _evict(cls):
+        while cls.__listings__ and cls.current_bytes > cls.max_bytes:
+            _, entry = cls.__listings__.popitem(last=False)
+            cls.current_bytes -= entry[0]
 
 
 class ImageDir(object):
@@ -242,7 +433,7 @@ class ImageFile(object):
     @staticmethod
     def populateParts(imageFile):
         logging.debug("Getting image info for: " + imageFile.path)
-        image_info = pytsk3.Img_Info(imageFile.path)
+        image_info = ImageHandlePool.getImageInfo(imageFile.path)
         try:
             volume_info = pytsk3.Volume_Info(image_info)
         except:
@@ -251,7 +442,7 @@ class ImageFile(object):
             # defined. For file systems like FAT12, with no partition info, we need
             # to handle in an exception.
             try:
-                fs_info = pytsk3.FS_Info(image_info, offset=0)
+                fs_info = ImageHandlePool.getFileSystemInfo(imageFile.path, 0)
             except:
                 # Botch by populating with file system details
                 imageFile.__partitions__.append(
@@ -284,7 +475,8 @@ class ImageFile(object):
                 # Open the file system for this image at the extracted
                 # start_offset.
                 try:
-                    fs_info = pytsk3.FS_Info(image_info, offset=(part.start * 512))
+                    fs_info = ImageHandlePool.getFileSystemInfo(imageFile.path,
+                                                                part.start * 512)
                 except:
                     # Exception, log and loop
                     logging.warn("Sleuth toolkit exception thrown getting partition: " +
@@ -316,30 +508,61 @@ class ImagePart(object):
 
 
 class FileSysEle(object):
-    # def __init__(self, path, size, mode, mtime, atime, ctime, addr, isDir,
-    # isDeleted):
+    """A file system element read from a disk image. Instances are slotted and
+    hold raw epoch times, names and formatted times are only worked out when
+    a template or serializer asks for them.
+    """
+    __slots__ = ['path', 'size', 'mode', 'mtimeEpoch', 'atimeEpoch', 'ctimeEpoch',
+                 'addr', 'isDir', 'isDeleted', 'isCandidate']
 
     def __init__(self, path, size, mode, mtime, atime, ctime, addr, isDir, isDeleted, isCandidate):
         self.path = path
-        self.name = ntpath.basename(path)
-        _ , self.extension = os.path.splitext(path)
         self.size = size
         self.mode = mode
-        self.mtime = datetime.datetime.fromtimestamp(
-            mtime).isoformat() if mtime != 0 else Defaults.NA
-        self.atime = datetime.datetime.fromtimestamp(
-            atime).isoformat() if atime != 0 else Defaults.NA
-        self.ctime = datetime.datetime.fromtimestamp(
-            ctime).isoformat() if ctime != 0 else Defaults.NA
+        self.mtimeEpoch = mtime
+        self.atimeEpoch = atime
+        self.ctimeEpoch = ctime
         self.addr = addr
         self.isDir = isDir
         self.isDeleted = isDeleted
         self.isCandidate = isCandidate
 
+    @property
+    def name(self):
+        return ntpath.basename(self.path)
+
+    @property
+    def extension(self):
+        return os.path.splitext(self.path)[1]
+
+    @property
+    def mtime(self):
+        return format_epoch(self.mtimeEpoch)
+
+    @property
+    def atime(self):
+        return format_epoch(self.atimeEpoch)
+
+    @property
+    def ctime(self):
+        return format_epoch(self.ctimeEpoch)
+
     def isDirectory(self):
         """Return true if this is a directory."""
         return self.isDir
 
+    def inDirectory(self, parent_path):
+        """Returns a copy of this element, whose path is its name, with the
+        display path of its parent directory prefixed."""
+        return FileSysEle(parent_path + self.path, self.size, self.mode,
+                          self.mtimeEpoch, self.atimeEpoch, self.ctimeEpoch,
+                          self.addr, self.isDir, self.isDeleted, self.isCandidate)
+
+    def memorySize(self):
+        """Returns an estimate of the memory held by this instance in bytes."""
+        return sys.getsizeof(self) + \
+               sum(sys.getsizeof(getattr(self, slot)) for slot in self.__slots__)
+
     @classmethod
     def rootElement(cls):
         rootObj = cls('/', 0, '', 0, 0, 0, -1, True, False, False)
@@ -351,6 +574,10 @@ class FileSysEle(object):
         if is_root(parent_path, file_name):
             rootEle = cls.rootElement()
             return rootEle
+        tree = cls.getTree(image_path, imagePart, block_size)
+        if tree is not None:
+            entry = tree.byPath(path)
+            return cls.fromCatalogEntry(path, entry) if entry is not None else None
         return cls.getFileFromDir(image_path, imagePart.start, block_size,
                                   parent_path, file_name)
 
@@ -375,61 +602,234 @@ class FileSysEle(object):
                   is_candidate(info))
         return ele
 
+    @classmethod
+    def fromMetaInfo(cls, path, info):
+        """Creates a new FileSysEle instance for a file opened by meta address,
+        these carry no name information so the display path is supplied."""
+        ele = cls(path, info.meta.size, info.meta.mode,
+                  info.meta.mtime, info.meta.atime, info.meta.ctime,
+                  info.meta.addr, is_dir(info.meta.type), is_deleted(info),
+                  is_candidate_name(ntpath.basename(path)))
+        return ele
+
+    @classmethod
+    def fromCatalogEntry(cls, path, entry):
+        """Creates a new FileSysEle instance from a catalogued file entry."""
+        ele = cls(path, entry.size, entry.mode,
+                  entry.mtime, entry.atime, entry.ctime, entry.addr,
+                  entry.is_dir, entry.is_deleted, entry.is_candidate)
+        return ele
+
+    @classmethod
+    def fromImageInode(cls, image_path, imagePart, block_size, addr, path):
+        """Opens a file system element directly by its meta address (inode),
+        path is only used for display."""
+        tree = cls.getTree(image_path, imagePart, block_size)
+        if tree is not None:
+            entry = tree.byAddr(addr)
+            if entry is not None:
+                return cls.fromCatalogEntry(path, entry)
+        file_sys_info = cls.getFileSystemInfo(image_path, imagePart.start,
+                                              block_size)
+        image_file = file_sys_info.open_meta(inode=addr)
+        return cls.fromMetaInfo(path, image_file.info)
+
     @staticmethod
     def getFileSystemInfo(image_path, start, block_size):
         logging.debug("Getting Image info for:" + image_path +
                       " start:" + str(start) + " size:" + str(block_size))
-        image_info = pytsk3.Img_Info(image_path)
-        # Open the file system for this image at the extracted
-        # start_offset.
-        logging.debug("Getting Image Info offset:" + str(start * block_size))
-        fs = pytsk3.FS_Info(image_info, offset=(start * block_size))
-        return fs
+        # Borrow the file system for this image at the extracted
+        # start_offset from the process wide pool.
+        return ImageHandlePool.getFileSystemInfo(image_path, start * block_size)
 
     @classmethod
     def listFiles(cls, image_path, imagePart, block_size, path):
-        file_list = []
+        """Generator yielding the elements of the directory at path."""
+        tree = cls.getTree(image_path, imagePart, block_size)
+        if tree is not None:
+            addr = tree.addrForPath(path)
+        else:
+            file_sys_info = cls.getFileSystemInfo(
+                image_path, imagePart.start, block_size)
+            addr = file_sys_info.open(path).info.meta.addr
+        return cls.listFilesByInode(image_path, imagePart, block_size, addr, path)
+
+    @classmethod
+    def listFilesByInode(cls, image_path, imagePart, block_size, addr, path):
+        """Generator yielding the elements of the directory with meta address
+        addr without walking its path, path is the directory's display path.
+        Listings are served from the ListingCache where possible, a listing
+        read from the image is cached once it has been read. Cached elements
+        hold names only, the display path is added as they're served. The
+        partition's tree index is used instead if enabled."""
+        tree = cls.getTree(image_path, imagePart, block_size)
+        if tree is not None:
+            return cls._listTree(tree, addr, dir_display_path(path))
+        key = (image_identity(image_path), imagePart.start * block_size, addr)
+        file_list = ListingCache.get(key)
+        if file_list is not None:
+            return cls._listCached(file_list, dir_display_path(path))
         file_sys_info = cls.getFileSystemInfo(
             image_path, imagePart.start, block_size)
-        directory = file_sys_info.open_dir(path=path)
+        directory = file_sys_info.open_dir(inode=addr)
+        return cls._cacheListing(key, cls._listDirectory(directory),
+                                 dir_display_path(path))
+
+    @classmethod
+    def getTree(cls, image_path, imagePart, block_size):
+        """Returns the partition's DirTree, building it on first access, or None
+        if the tree index is disabled."""
+        if not TreeIndexCache.isEnabled():
+            return None
+        offset = imagePart.start * block_size
+        return TreeIndexCache.get((image_identity(image_path), offset),
+                                  lambda: cls._buildTree(image_path, imagePart,
+                                                         block_size))
+
+    @classmethod
+    def _buildTree(cls, image_path, imagePart, block_size):
+        walker = cls.walkPartition(image_path, imagePart, block_size)
+        root_addr = next(walker)
+        return DirTree(root_addr, walker)
+
+    @classmethod
+    def _listTree(cls, tree, addr, parent_path):
+        for entry in tree.children(addr):
+            yield cls.fromCatalogEntry(parent_path + entry.name, entry)
+
+    @staticmethod
+    def _listCached(file_list, parent_path):
+        for ele in file_list:
+            yield ele.inDirectory(parent_path)
+
+    @classmethod
+    def _listDirectory(cls, directory):
+        """Yields an element, with its name as its path, per directory entry."""
         for listed_file in directory:
             if listed_file.info.meta != None:
-                file_list.append(FileSysEle.fromFileInfo(
-                    '/' + path + '/', listed_file.info))
-        return file_list
+                yield FileSysEle.fromFileInfo('', listed_file.info)
+
+    @staticmethod
+    def _cacheListing(key, files, parent_path):
+        """Passes files through with parent_path added to their paths, caching
+        the complete listing of names unless it outgrows the ListingCache
+        memory budget. A listing abandoned part way,
+        e.g. at the end of a page, is read on to the end when the generator is
+        closed so directories larger than a page are cached too."""
+        collected = []
+        size = 0
+        abandoned = False
+        for ele in files:
+            if collected is not None:
+                size += ele.memorySize()
+                if size > ListingCache.max_bytes:
+                    collected = None
+                else:
+                    collected.append(ele)
+            if abandoned:
+                if collected is None:
+                    return
+            else:
+                try:
+                    yield ele.inDirectory(parent_path)
+                except GeneratorExit:
+                    if collected is None:
+                        return
+                    abandoned = True
+        if collected is not None:
+            ListingCache.put(key, collected)
 
     @classmethod
-    def createTempCopy(cls, image_path, start, block_size, fsEle):
-        """Creates a temp file copy of a file from the specified image."""
-        generator = cls.payloadGenerator(image_path, start, block_size, fsEle)
-        # Open with a named temp file
-        with tempfile.NamedTemporaryFile(delete=False) as temp:
+    def walkPartition(cls, image_path, imagePart, block_size):
+        """Generator that walks every directory of a partition once, yielding
+        a file entry table map for each directory entry found. The root
+        directory's meta address is available as the generator's first yield.
+        """
+        file_sys_info = cls.getFileSystemInfo(
+            image_path, imagePart.start, block_size)
+        root_addr = file_sys_info.info.root_inum
+        yield root_addr
+        pending = [root_addr]
+        visited = set(pending)
+        while pending:
+            dir_addr = pending.pop()
+            try:
+                directory = file_sys_info.open_dir(inode=dir_addr)
+            except IOError:
+                logging.warn("Failed to open directory " + str(dir_addr) +
+                             " in image: " + image_path)
+                continue
+            for listed_file in directory:
+                info = listed_file.info
+                if info.meta is None:
+                    continue
+                yield to_file_db_map(dir_addr, info)
+                if is_dir(info.meta.type) and info.meta.addr not in visited:
+                    visited.add(info.meta.addr)
+                    pending.append(info.meta.addr)
+
+    @classmethod
+    def walkPartitionPaths(cls, image_path, imagePart, block_size):
+        """Generator that walks a partition like walkPartition, yielding the
+        (path, file entry table map) of each entry other than . and ..
+        entries. A directory reached by several paths is walked at the first.
+        """
+        walker = cls.walkPartition(image_path, imagePart, block_size)
+        dir_paths = {next(walker): u''}
+        for entry in walker:
+            name = entry[FileFlds.NAME]
+            if name in [u'.', u'..']:
+                continue
+            path = dir_paths.get(entry[FileFlds.PARENT], u'') + u'/' + name
+            if entry[FileFlds.IS_DIR]:
+                dir_paths.setdefault(entry[FileFlds.ADDR], path)
+            yield path, entry
+
+    @classmethod
+    @contextmanager
+    def spooledCopy(cls, image_path, start, block_size, fsEle, digests=None):
+        """Context manager yielding the path of a copy of a file from the
+        specified image, kept in the SpoolDir and shared by concurrent requests
+        for the file. If a DigestTee is passed as digests the content is hashed
+        as it's copied, or read back if it was already spooled."""
+        copied = []
+        def _write(spool_file):
+            generator = cls.payloadGenerator(image_path, start, block_size, fsEle)
+            if digests is not None:
+                generator = digests.tee(generator)
             for data in generator:
-                temp.write(data)
-                temp.flush()
-            # Return an opened temp file
-            return temp.name
+                spool_file.write(data)
+            copied.append(True)
+        key = (image_identity(image_path), start, fsEle.addr)
+        with SpoolDir.spooled(key, _write) as spool_path:
+            if digests is not None and not copied:
+                with open(spool_path, 'rb') as spooled:
+                    for _ in digests.tee(iter(lambda: spooled.read(ReadAhead.max_chunk), b'')):
+                        pass
+            yield spool_path
 
     @classmethod
-    def payloadGenerator(cls, image_path, start, block_size, fsEle):
-        """Generator used to loop through a file's content."""
+    def readHeader(cls, image_path, start, block_size, fsEle, length):
+        """Returns up to the first length bytes of a file's content."""
+        file_sys_info = cls.getFileSystemInfo(image_path, start, block_size)
+        image_file = file_sys_info.open_meta(inode=fsEle.addr)
+        length = min(length, image_file.info.meta.size)
+        return image_file.read_random(0, length) if length > 0 else b''
+
+    @classmethod
+    def payloadGenerator(cls, image_path, start, block_size, fsEle, offset=0,
+                         length=None):
+        """Generator used to loop through a file's content, or length bytes of
+        it from offset."""
         logging.debug("Getting image file information")
         file_sys_info = cls.getFileSystemInfo(image_path, start, block_size)
         image_file = file_sys_info.open_meta(inode=fsEle.addr)
-        # Set up the date copy process vars
-        offset = 0
         file_size = image_file.info.meta.size
-        buff_size = 1024 * 1024
-        # Loop through data read and yield it 1MB chunk at a time
-        logging.debug("Starting delivery loop, file_size:" + str(file_size) + " Bytes.")
-        while offset < file_size:
-            available = min(buff_size, file_size - offset)
-            data = image_file.read_random(offset, available)
-            offset += len(data)
-            # If no data then break the generator loop
-            if not data:
-                break
-            yield data
+        offset = min(offset, file_size)
+        length = file_size - offset if length is None else min(length, file_size - offset)
+        logging.debug("Starting delivery loop, file_size:" + str(file_size) +
+                      " Bytes, offset:" + str(offset) + " length:" + str(length))
+        return ReadAhead.chunks(image_file, offset, length)
 
     @classmethod
     def GuessMimeType(cls, file_name):
@@ -446,20 +846,164 @@ class FileSysEle(object):
         """
         return MimeTypes().guess_type(file_name)[0]
 
-class ByteSequence(object):
+class ReadAhead(object):
+    """Adaptive read ahead for file content read from images. Reads start at
+    min_chunk bytes and double with each sequential read up to max_chunk, so
+    small files aren't over read and large files get large reads. If prefetch
+    is set a background thread reads the next chunk while the current one is
+    being sent. Throughput is logged per transfer and totalled for stats.
     """
-    Class to hold basic details of a ByteSequence, used in file analysis.
-    """
-    def __init__(self, sha1, size, is_candidate):
-        self.sha1 = sha1
-        self.size = size
-        self.is_candidate = is_candidate
+    min_chunk = 64 * 1024
+    max_chunk = 4 * 1024 * 1024
+    prefetch = True
+    transfers = 0
+    total_bytes = 0
+    total_seconds = 0.0
+    __lock__ = threading.Lock()
 
     @classmethod
-    def rootElement(cls):
-        rootObj = cls('/', 0, '', 0, 0, 0, -1, True, False, False)
-        return rootObj
+    def configure(cls, min_chunk, max_chunk, prefetch):
+        cls.min_chunk = max(512, int(min_chunk))
+        cls.max_chunk = max(cls.min_chunk, int(max_chunk))
+        cls.prefetch = prefetch
+
+    @classmethod
+    def chunks(cls, image_file, offset, length):
+        """Generator yielding length bytes of image_file's content from offset."""
+        reads = cls._reads(image_file, offset, length)
+        if cls.prefetch:
+            reads = cls._prefetched(reads)
+        return cls._measured(reads)
+
+    @classmethod
+    def stats(cls):
+        """Returns a dictionary of transfer totals."""
+        return {
+            'transfers': cls.transfers,
+            'bytes': cls.total_bytes,
+            'seconds': round(cls.total_seconds, 3),
+            'mb_per_second': round(cls.total_bytes / (1024.0 * 1024.0) /
+                                   cls.total_seconds, 3) if cls.total_seconds else 0.0,
+            'min_chunk': cls.min_chunk,
+            'max_chunk': cls.max_chunk
+        }
 
+    @classmethod
+    def _reads(cls, image_file, offset, length):
+        end = offset + length
+        chunk_size = cls.min_chunk
+        while offset < end:
+            data = image_file.read_random(offset, min(chunk_size, end - offset))
+            # If no data then break the generator loop
+            if not data:
+                break
+            offset += len(data)
+            chunk_size = min(chunk_size * 2, cls.max_chunk)
+            yield data
+
+    @staticmethod
+    def _prefetched(reads):
+        """Runs reads in a background thread one chunk ahead of the consumer."""
+        chunks = Queue.Queue(maxsize=1)
+        stop = threading.Event()
+        done = object()
+
+        def _offer(item):
+            # Give up if the consumer has gone, e.g. the client disconnected
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=1)
+                    return True
+                except Queue.Full:
+                    continue
+            return False
+
+        def _read():
+            try:
+                for data in reads:
+                    if not _offer(data):
+                        return
+                _offer(done)
+            except Exception as excep:
+                _offer(excep)
+
+        reader = threading.Thread(target=_read, name='bcaw-read-ahead')
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                data = chunks.get()
+                if data is done:
+                    break
+                if isinstance(data, Exception):
+                    raise data
+                yield data
+        finally:
+            stop.set()
+
+    @classmethod
+    def _measured(cls, reads):
+        started = time.time()
+        sent = 0
+        try:
+            for data in reads:
+                sent += len(data)
+                yield data
+        finally:
+            elapsed = time.time() - started
+            logging.debug("Sent %d bytes in %.3fs, %.2f MB/s", sent, elapsed,
+                          sent / (1024.0 * 1024.0) / elapsed if elapsed else 0.0)
+            with cls.__lock__:
+                cls.transfers += 1
+                cls.total_bytes += sent
+                cls.total_seconds += elapsed
+
+
+class ListingPage(object):
+    """A page of a directory listing, an iterable over at most limit elements
+    starting at offset, optionally sorted by one of SORT_KEYS. Unsorted pages
+    only read as far into the listing as needed, sorted pages keep at most
+    offset + limit elements in memory. has_next is set once iteration finds
+    there are further elements.
+    """
+    SORT_KEYS = {
+        'name': lambda ele: ele.name.lower(),
+        'size': lambda ele: ele.size,
+        'mtime': lambda ele: ele.mtimeEpoch
+    }
+
+    def __init__(self, files, offset=0, limit=None, sort_by=None, reverse=False):
+        self.offset = max(0, offset)
+        self.limit = None if limit is None else max(1, limit)
+        self.sort_by = sort_by if sort_by in self.SORT_KEYS else None
+        self.reverse = reverse
+        self.count = 0
+        self.has_next = False
+        self._files = files
+
+    def hasPrevious(self):
+        return self.offset > 0
+
+    def __iter__(self):
+        # Select one element beyond the page to detect a next page
+        stop = None if self.limit is None else self.offset + self.limit + 1
+        if self.sort_by is None:
+            selected = itertools.islice(self._files, self.offset, stop)
+        else:
+            sort_key = self.SORT_KEYS[self.sort_by]
+            if stop is None:
+                selected = sorted(self._files, key=sort_key, reverse=self.reverse)
+            elif self.reverse:
+                selected = heapq.nlargest(stop, self._files, key=sort_key)
+            else:
+                selected = heapq.nsmallest(stop, self._files, key=sort_key)
+            selected = selected[self.offset:]
+        for ele in selected:
+            if self.limit is not None and self.count >= self.limit:
+                self.has_next = True
+                break
+            self.count += 1
+            yield ele
 
 
 def mapped_dict_from_element(root, parent_tags, tag_dict):
@@ -482,6 +1026,53 @@ def mapped_dict_from_element(root, parent_tags, tag_dict):
             mapped_dict[field] = child.text
     return mapped_dict
 
+def to_file_db_map(parent_addr, info):
+    """Maps a pytsk3 directory entry to DB file entry table fields."""
+    return {
+        FileFlds.ADDR: info.meta.addr,
+        FileFlds.PARENT: parent_addr,
+        FileFlds.NAME: decode_name(info.name.name),
+        FileFlds.SIZE: info.meta.size,
+        FileFlds.MODE: int(info.meta.mode),
+        FileFlds.MTIME: info.meta.mtime,
+        FileFlds.ATIME: info.meta.atime,
+        FileFlds.CTIME: info.meta.ctime,
+        FileFlds.IS_DIR: is_dir(info.meta.type),
+        FileFlds.IS_DELETED: is_deleted(info),
+        FileFlds.IS_CANDIDATE: is_candidate(info)
+    }
+
+def decode_name(name):
+    """Decodes a file name read from an image, replacing invalid UTF-8.
+    DOCTESTS:
+    >>> decode_name('report.pdf')
+    u'report.pdf'
+    >>> decode_name('caf\\xc3\\xa9.txt')
+    u'caf\\xe9.txt'
+    """
+    if isinstance(name, unicode):
+        return name
+    return name.decode('utf-8', 'replace')
+
+def image_identity(image_path):
+    """Returns a tuple identifying the current state of an image file, its
+    path, size and mtime. Evidence images are immutable so a change in identity
+    means the file has been replaced.
+    """
+    stat = os.stat(image_path)
+    return (image_path, stat.st_size, int(stat.st_mtime))
+
+def format_epoch(epoch):
+    """Formats an epoch time read from an image as a local ISO date time,
+    zero (unset) times are returned as N/A.
+    DOCTESTS:
+    >>> format_epoch(0)
+    'N/A'
+    """
+    if not epoch:
+        return Defaults.NA
+    return datetime.datetime.fromtimestamp(epoch).isoformat()
+
 def date_string_to_date(date_string):
     return datetime.datetime.strptime(date_string, "%Y-%m-%dT%H:%M:%S")
 
@@ -496,7 +1087,21 @@ def is_candidate(info):
     """Check if this is a candidate for text extraction
     Get just the extension (this is dirty, also gets dotfile names now)
     """
-    file_ext = (info.name.name).rsplit('.', 1)
+    return is_candidate_name(info.name.name)
+
+def is_candidate_name(file_name):
+    """Check if the file name has an extension supported for text extraction.
+    DOCTESTS:
+    >>> is_candidate_name('report.pdf')
+    True
+    >>> is_candidate_name('REPORT.PDF')
+    True
+    >>> is_candidate_name('kernel32.dll')
+    False
+    >>> is_candidate_name('README')
+    False
+    """
+    file_ext = file_name.rsplit('.', 1)
     if len(file_ext) > 1:
         return file_ext[1] in FileExtns.ALLEXT
         #logging.debug("End after split:" + fa[1])
@@ -508,5 +1113,18 @@ def is_dir(meta_type):
     """
     return meta_type == 2
 
+def dir_display_path(path):
+    """Normalises a directory path for use as the display prefix of its entries.
+    DOCTESTS:
+    >>> dir_display_path('/')
+    '/'
+    >>> dir_display_path('Windows/System32')
+    '/Windows/System32/'
+    >>> dir_display_path('//Documents/')
+    '/Documents/'
+    """
+    stripped = path.strip(PathChars.PATH_SEP_FOR)
+    return '/' + stripped + '/' if stripped else '/'
+
 def is_root(parent, file_to_check):
     return (parent in PathChars.SEPS) and not file_to_check
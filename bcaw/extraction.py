@@ -0,0 +1,291 @@
+#!/usr/bin/python
+# coding=UTF-8
+#
+# BitCurator Access Webtools (Disk Image Access for the Web)
+# Copyright (C) 2014 - 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""Text extraction run in isolated, resource limited worker processes."""
+import codecs
+import cPickle
+import errno
+import json
+import logging
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+from HTMLParser import HTMLParseError
+
+from bcaw.utilities import detect_encoding, json_strings, HtmlText
+
+BUFF_SIZE = 64 * 1024
+# Script run by the worker processes, by path as it mustn't import bcaw
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'extraction_worker.py')
+
+class ExtractionError(Exception):
+    """Raised when text extraction fails, the message is fit for display."""
+    pass
+
+class ExtractionTimeout(ExtractionError):
+    """Raised when text extraction is terminated for running too long."""
+    pass
+
+def decoded_chunks(file_path, max_bytes=0, deadline=None):
+    """Generator yielding the unicode content of a text file in chunks, the
+    encoding detected from the first chunk. Only the first max_bytes of the
+    file are decoded, unless 0, raises ExtractionTimeout if the time passes
+    deadline first."""
+    remaining = max_bytes or -1
+    with open(file_path, 'rb') as text_file:
+        chunk = text_file.read(_read_size(remaining))
+        decoder = codecs.getincrementaldecoder(detect_encoding(chunk))('replace')
+        while chunk:
+            if deadline is not None and time.time() > deadline:
+                raise ExtractionTimeout("Text extraction timed out.")
+            yield decoder.decode(chunk)
+            remaining -= len(chunk)
+            if remaining == 0:
+                if text_file.read(1):
+                    logging.warn("Truncated text extraction of %s at %d bytes",
+                                 file_path, max_bytes)
+                break
+            chunk = text_file.read(_read_size(remaining))
+        yield decoder.decode(b'', True)
+
+def extract_text(file_path, max_bytes=0, deadline=None):
+    """Native extractor for plain text, decodes the file, truncated at
+    max_bytes."""
+    return u''.join(decoded_chunks(file_path, max_bytes, deadline))
+
+def extract_html(file_path, max_bytes=0, deadline=None):
+    """Native extractor for HTML, strips tags as the file's decoded, truncated
+    at max_bytes."""
+    parser = HtmlText()
+    try:
+        for chunk in decoded_chunks(file_path, max_bytes, deadline):
+            parser.feed(chunk)
+        parser.close()
+    except HTMLParseError as excep:
+        # Keep the text parsed before the markup broke the parser
+        logging.debug("Stopped parsing HTML %s: %s", file_path, excep)
+    return parser.text()
+
+def extract_json(file_path, max_bytes=0, deadline=None):
+    """Native extractor for JSON, the document's keys and string values.
+    Documents over max_bytes fail as they can't be parsed truncated."""
+    if max_bytes and os.path.getsize(file_path) > max_bytes:
+        raise ExtractionError("Text extraction failed: JSON document over %d bytes."
+                              % max_bytes)
+    try:
+        document = json.loads(extract_text(file_path, deadline=deadline))
+    except ValueError as excep:
+        raise ExtractionError("Text extraction failed: invalid JSON, %s" % excep)
+    return u'\n'.join(json_strings(document))
+
+# Extractors run in process rather than by textract, keyed by extension
+NATIVE_EXTRACTORS = {
+    'txt': extract_text,
+    'html': extract_html,
+    'json': extract_json
+}
+
+class ExtractionPool(object):
+    """Runs textract in a worker process per file, at most max_workers at
+    once with any further requests queued. Workers execute a fresh interpreter
+    rather than forking this one, which may hold whole images memory mapped,
+    so the address space cap of memory_limit bytes only counts the
+    extraction. Each worker is the leader of its own process group, so the
+    converters textract shells out to are killed along with it when the
+    timeout for the file's extension is exceeded. Extensions in native are
+    extracted in process by NATIVE_EXTRACTORS instead, reading at most
+    native_max_bytes of the file within the extension's timeout.
+    """
+    max_workers = 2
+    default_timeout = 120
+    timeouts = {}
+    memory_limit = 0
+    native = frozenset()
+    native_max_bytes = 64 * 1024 * 1024
+    queued = 0
+    running = 0
+    timed_out = 0
+    failed = 0
+    __workers__ = threading.BoundedSemaphore(max_workers)
+    __extractors__ = {}
+    __lock__ = threading.Lock()
+
+    @classmethod
+    def configure(cls, max_workers, default_timeout, timeouts=None, memory_limit=0,
+                  native=None, native_max_bytes=None):
+        """Sets the number of concurrent workers, the default and per extension
+        timeouts in seconds, the worker memory limit in bytes, 0 for none, the
+        extensions extracted natively and the bytes they decode, 0 for all.
+        """
+        unknown = set(native or []) - set(NATIVE_EXTRACTORS)
+        if unknown:
+            raise ValueError("No native extractor for: " + ", ".join(sorted(unknown)))
+        cls.native = frozenset(native or [])
+        cls.max_workers = max(1, int(max_workers))
+        cls.__workers__ = threading.BoundedSemaphore(cls.max_workers)
+        cls.default_timeout = default_timeout
+        cls.timeouts = dict(timeouts or {})
+        cls.memory_limit = max(0, int(memory_limit))
+        if native_max_bytes is not None:
+            cls.native_max_bytes = max(0, int(native_max_bytes))
+
+    @classmethod
+    def extract(cls, file_path, extension):
+        """Returns the text textract extracts from the file at file_path,
+        treated as a file with the given extension. Raises ExtractionError if
+        the worker fails or exceeds its time or memory limits.
+        """
+        timeout = cls.timeouts.get(extension, cls.default_timeout)
+        if extension in cls.native:
+            return cls._native(file_path, extension, timeout)
+        with cls.__lock__:
+            cls.queued += 1
+        workers = cls.__workers__
+        workers.acquire()
+        with cls.__lock__:
+            cls.queued -= 1
+            cls.running += 1
+        started = time.time()
+        try:
+            return cls._run(file_path, extension, timeout)
+        except ExtractionTimeout:
+            with cls.__lock__:
+                cls.timed_out += 1
+            raise
+        except ExtractionError:
+            with cls.__lock__:
+                cls.failed += 1
+            raise
+        finally:
+            cls._measured(extension, time.time() - started)
+            with cls.__lock__:
+                cls.running -= 1
+            workers.release()
+
+    @classmethod
+    def stats(cls):
+        """Returns a dictionary of pool counters, with the count, mean and max
+        seconds of each extractor keyed by extension."""
+        with cls.__lock__:
+            stats = {
+                'max_workers': cls.max_workers,
+                'queue_depth': cls.queued,
+                'running': cls.running,
+                'timed_out': cls.timed_out,
+                'failed': cls.failed
+            }
+            for extension, (count, total, longest) in cls.__extractors__.items():
+                stats['extractor_' + extension] = '%d runs, mean %.2fs, max %.2fs' % \
+                                                  (count, total / count, longest)
+            return stats
+
+    @classmethod
+    def _measured(cls, extension, seconds):
+        with cls.__lock__:
+            count, total, longest = cls.__extractors__.get(extension, (0, 0.0, 0.0))
+            cls.__extractors__[extension] = (count + 1, total + seconds,
+                                             max(longest, seconds))
+
+    @classmethod
+    def _native(cls, file_path, extension, timeout):
+        started = time.time()
+        try:
+            return NATIVE_EXTRACTORS[extension](file_path, cls.native_max_bytes,
+                                                started + timeout)
+        except ExtractionTimeout:
+            logging.warn("Extraction of %s stopped after %d seconds", file_path, timeout)
+            with cls.__lock__:
+                cls.timed_out += 1
+            raise ExtractionTimeout("Text extraction timed out after %d seconds." % timeout)
+        except ExtractionError:
+            with cls.__lock__:
+                cls.failed += 1
+            raise
+        finally:
+            cls._measured('native_' + extension, time.time() - started)
+
+    @classmethod
+    def _run(cls, file_path, extension, timeout):
+        try:
+            worker = subprocess.Popen([_interpreter(), WORKER_SCRIPT, file_path,
+                                       extension, str(cls.memory_limit)],
+                                      stdout=subprocess.PIPE, close_fds=True)
+        except OSError as excep:
+            raise ExtractionError("Text extraction failed: %s" % excep)
+        try:
+            data = _read_until(worker.stdout.fileno(), time.time() + timeout)
+        finally:
+            worker.stdout.close()
+        if data is None:
+            _kill_group(worker.pid)
+            worker.wait()
+            logging.warn("Extraction of %s killed after %d seconds", file_path, timeout)
+            raise ExtractionTimeout("Text extraction timed out after %d seconds." % timeout)
+        returncode = worker.wait()
+        try:
+            succeeded, result = cPickle.loads(data)
+        except Exception:
+            # Nothing or a partial result, the worker died writing it
+            raise ExtractionError(_exit_message(returncode))
+        if not succeeded:
+            raise ExtractionError(result)
+        return result
+
+def _read_size(remaining):
+    """Bytes to read next given remaining bytes to read, negative for all."""
+    return BUFF_SIZE if remaining < 0 else min(BUFF_SIZE, remaining)
+
+def _read_until(read_fd, deadline):
+    """Reads read_fd to EOF, returns None if deadline passes first."""
+    chunks = []
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        try:
+            readable, _, _ = select.select([read_fd], [], [], remaining)
+        except select.error as excep:
+            if excep.args[0] == errno.EINTR:
+                continue
+            raise
+        if not readable:
+            return None
+        chunk = os.read(read_fd, 64 * 1024)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+def _kill_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        # Worker may not have called setsid yet, or already exited
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+def _exit_message(returncode):
+    if returncode < 0:
+        return "Text extraction worker killed by signal %d." % -returncode
+    return "Text extraction worker exited with status %d." % returncode
+
+def _interpreter():
+    """Returns the Python interpreter to run workers with, embedded
+    interpreters, e.g. uWSGI's, report their own binary as sys.executable."""
+    if os.path.basename(sys.executable or '').startswith('python'):
+        return sys.executable
+    return os.path.join(sys.prefix, 'bin', 'python')
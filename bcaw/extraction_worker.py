@@ -0,0 +1,45 @@
+#!/usr/bin/python
+# coding=UTF-8
+#
+# BitCurator Access Webtools (Disk Image Access for the Web)
+# Copyright (C) 2014 - 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""Text extraction worker, executed as a fresh interpreter by ExtractionPool
+so it inherits none of the web or Celery process's memory, e.g. memory
+mapped images. Deliberately imports nothing from bcaw.
+
+Usage: extraction_worker.py <file path> <extension> <memory limit bytes>
+
+Writes the pickled (succeeded, text or error message) result to stdout.
+"""
+import cPickle
+import os
+import resource
+import sys
+
+def main(file_path, extension, memory_limit):
+    """Extracts the text of the file, leading its own process group so the
+    converters textract shells out to can be killed along with it."""
+    # Keep converter output off the result stream
+    result_file = os.fdopen(os.dup(1), 'wb')
+    os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+    os.setsid()
+    from textract import process
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    try:
+        result = (True, process(file_path, extension=extension, encoding='ascii'))
+    except MemoryError:
+        result = (False, "Text extraction exceeded the memory limit.")
+    except Exception as excep:
+        result = (False, "Text extraction failed: %s" % excep)
+    cPickle.dump(result, result_file, cPickle.HIGHEST_PROTOCOL)
+    result_file.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2], int(sys.argv[3]))
@@ -0,0 +1,338 @@
+#!/usr/bin/python
+# coding=UTF-8
+#
+# BitCurator Access Webtools (Disk Image Access for the Web)
+# Copyright (C) 2014 - 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""Hashes every file in a partition in parallel worker processes, storing the
+per file digests and exporting them as CSV or DFXML manifests."""
+import cPickle
+import csv
+import datetime
+import errno
+import logging
+import os
+import select
+import signal
+import struct
+import time
+from cStringIO import StringIO
+from xml.sax.saxutils import escape, quoteattr
+
+from bcaw import app
+from bcaw.const import AnalysisStatus, ConfKey, FileFlds
+from bcaw.disk_utils import FileSysEle, ImageHandlePool, ReadAhead
+from bcaw.known_files import KnownFiles
+from bcaw.model import db, FileHash, HashRun, Image, Partition
+from bcaw.utilities import DigestTee
+
+# Length prefix of the pickled records workers send to the parent
+RECORD_HEADER = struct.Struct('!I')
+MANIFEST_DIGESTS = ['md5', 'sha1', 'sha256']
+# Seconds between saves of a live run, well inside HASH_RUN_TIMEOUT so long
+# files between checkpoints don't make the run look stale
+HEARTBEAT_SECONDS = 60
+
+def hash_partition(part_id):
+    """Hashes every regular file in the partition with id part_id that
+    hasn't been hashed by a previous run, so an interrupted run resumes where
+    it stopped. Files are shared between HASH_WORKERS processes and their
+    digests committed every HASH_CHECKPOINT_FILES files, the run is saved
+    at least every HEARTBEAT_SECONDS so it isn't taken for stale. Files are
+    checked against the KnownFiles as their digests arrive.
+    """
+    image_part = Partition.byId(part_id)
+    image = Image.byId(image_part.image_id)
+    run = HashRun.byPartId(part_id) or HashRun(part_id)
+    run.status = AnalysisStatus.RUNNING
+    run.started = datetime.datetime.utcnow()
+    run.finished = None
+    run.errors = 0
+    run.files, run.bytes = FileHash.totalsForPartId(part_id)
+    HashRun.save(run)
+
+    hashed = FileHash.addrsForPartId(part_id)
+    files = dict((addr, (path, size)) for addr, path, size
+                 in partition_files(image.path, image_part, image.bps)
+                 if addr not in hashed)
+    logging.info("Hashing %d files in partition %d, %d already hashed",
+                 len(files), part_id, len(hashed))
+    checkpoint = app.config[ConfKey.HASH_CHECKPOINT_FILES]
+    algorithms = set(app.config[ConfKey.HASH_ALGORITHMS]) | set(['sha1'])
+    batch = []
+    worker_stats = []
+    saved = time.time()
+    try:
+        for record in run_workers(image.path, image_part.start, image.bps,
+                                  [(addr, size) for addr, (_, size) in files.items()],
+                                  algorithms, app.config[ConfKey.HASH_WORKERS],
+                                  HEARTBEAT_SECONDS):
+            if time.time() - saved >= HEARTBEAT_SECONDS:
+                HashRun.save(run)
+                saved = time.time()
+            kind = record[0]
+            if kind == 'heartbeat':
+                continue
+            elif kind == 'worker':
+                worker_stats.append(record[1])
+            elif kind == 'error':
+                run.errors += 1
+                logging.warn("Failed to hash %s in partition %d: %s",
+                             files[record[1]][0], part_id, record[2])
+            else:
+                _, addr, digests = record
+                path, size = files[addr]
+                batch.append({
+                    FileFlds.PARTITION: part_id,
+                    FileFlds.ADDR: addr,
+                    'path': path,
+                    FileFlds.SIZE: size,
+                    'md5': digests.get('md5'),
+                    'sha1': digests.get('sha1'),
+                    'sha256': digests.get('sha256'),
+                    'is_known': KnownFiles.isKnown(digests.get('sha1'))
+                })
+                if len(batch) >= checkpoint:
+                    _checkpoint(run, batch)
+        _checkpoint(run, batch)
+        run.status = AnalysisStatus.COMPLETE
+    except Exception:
+        logging.exception("Hashing partition %d failed", part_id)
+        # Drop the uncommitted batch, resuming the run hashes its files again
+        errors = run.errors
+        db.session.rollback()
+        del batch[:]
+        run.files, run.bytes = FileHash.totalsForPartId(part_id)
+        run.errors = errors
+        run.status = AnalysisStatus.FAILED
+    run.finished = datetime.datetime.utcnow()
+    run.setWorkerStats(worker_stats)
+    HashRun.save(run)
+    for stats in worker_stats:
+        logging.info("Hash worker %(pid)d: %(files)d files, %(bytes)d bytes, "
+                     "%(mb_per_sec).1f MB/s", stats)
+    return run
+
+def queue_partition_hashing(part_id):
+    """Submits a background hashing run for the partition to Celery, unless
+    one is already in progress. A stale run, one whose worker died, is
+    resumed."""
+    run = HashRun.byPartId(part_id) or HashRun(part_id)
+    if run.isInProgress():
+        if not is_stale(run):
+            return run
+        logging.warn("Hashing run for partition %d %s since %s, resuming",
+                     part_id, run.status, run.updated)
+    run.status = AnalysisStatus.QUEUED
+    HashRun.save(run)
+    # Imported here as the Celery task module imports the application
+    from bcaw_celery_task import bcawHashPartitionAsynchronously
+    try:
+        bcawHashPartitionAsynchronously.delay(part_id)
+    except Exception:
+        logging.exception("Failed to queue hashing of partition %d", part_id)
+        run.status = AnalysisStatus.FAILED
+        HashRun.save(run)
+    return run
+
+def is_stale(run):
+    """Checks if an in progress hashing run hasn't been saved within
+    HASH_RUN_TIMEOUT."""
+    timeout = datetime.timedelta(seconds=app.config[ConfKey.HASH_RUN_TIMEOUT])
+    return run.isInProgress() and \
+           (run.updated or run.started) < datetime.datetime.utcnow() - timeout
+
+def partition_files(image_path, image_part, block_size):
+    """Generator yielding the (meta address, path, size) of each regular file
+    in a partition once, hard links are reported at the first path found.
+    """
+    seen = set()
+    for path, entry in FileSysEle.walkPartitionPaths(image_path, image_part, block_size):
+        addr = entry[FileFlds.ADDR]
+        if not entry[FileFlds.IS_DIR] and addr not in seen:
+            seen.add(addr)
+            yield addr, path, entry[FileFlds.SIZE]
+
+def run_workers(image_path, start, block_size, files, algorithms, workers,
+                heartbeat=None):
+    """Generator hashing files, a list of (meta address, size) pairs, across
+    workers forked processes, yielding a ('file', addr, digests) or ('error',
+    addr, message) record per file and a ('worker', stats) record as each
+    worker finishes. The files of a worker that dies are reported as errors.
+    A ('heartbeat',) record is yielded when no worker reports for heartbeat
+    seconds. Files are dealt largest first to the least loaded worker so the
+    workers finish together.
+    """
+    shards = [[] for _ in range(min(max(1, workers), len(files)))]
+    loads = [0] * len(shards)
+    for addr, size in sorted(files, key=lambda item: item[1], reverse=True):
+        least = loads.index(min(loads))
+        shards[least].append(addr)
+        loads[least] += size
+    pipes = {}
+    try:
+        for shard in shards:
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                for other_fd in pipes:
+                    os.close(other_fd)
+                _worker(write_fd, image_path, start, block_size, shard, algorithms)
+            os.close(write_fd)
+            pipes[read_fd] = (pid, [b''], set(shard))
+        while pipes:
+            try:
+                readable, _, _ = select.select(list(pipes), [], [], heartbeat)
+            except select.error as excep:
+                if excep.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                yield ('heartbeat',)
+            for read_fd in readable:
+                pid, buff, unreported = pipes[read_fd]
+                chunk = os.read(read_fd, 64 * 1024)
+                if not chunk:
+                    os.close(read_fd)
+                    del pipes[read_fd]
+                    message = _exit_message(os.waitpid(pid, 0)[1])
+                    if message is not None:
+                        logging.error("Hash worker %d %s with %d files unhashed",
+                                      pid, message, len(unreported))
+                    elif unreported:
+                        message = "hash worker exited early"
+                    for addr in unreported:
+                        yield ('error', addr, message)
+                    continue
+                buff[0] += chunk
+                for record in _records(buff):
+                    if record[0] != 'worker':
+                        unreported.discard(record[1])
+                    yield record
+    finally:
+        # Only reached with pipes open if the consumer gave up, stop the workers
+        for read_fd, (pid, _, _) in pipes.items():
+            os.close(read_fd)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            os.waitpid(pid, 0)
+
+def hash_file(image_path, start, block_size, addr, algorithms):
+    """Returns the (hex digests, bytes read) of the file with meta address
+    addr, for each algorithm in algorithms."""
+    file_sys_info = FileSysEle.getFileSystemInfo(image_path, start, block_size)
+    image_file = file_sys_info.open_meta(inode=addr)
+    digests = DigestTee(algorithms)
+    read = 0
+    for chunk in digests.tee(ReadAhead.chunks(image_file, 0, image_file.info.meta.size)):
+        read += len(chunk)
+    return digests.hexdigests(), read
+
+def manifest_csv(part_id):
+    """Generator yielding the lines of a CSV hash manifest for a partition."""
+    buff = StringIO()
+    writer = csv.writer(buff)
+    writer.writerow(['path', 'inode', 'size'] + MANIFEST_DIGESTS + ['known'])
+    for file_hash in FileHash.forPartition(part_id).yield_per(1000):
+        writer.writerow([file_hash.path.encode('utf-8'), file_hash.addr, file_hash.size] +
+                        [getattr(file_hash, digest) or '' for digest in MANIFEST_DIGESTS] +
+                        [int(bool(file_hash.is_known))])
+        yield buff.getvalue()
+        buff.seek(0)
+        buff.truncate()
+    yield buff.getvalue()
+
+def manifest_dfxml(image, image_part):
+    """Generator yielding a DFXML hash manifest for a partition."""
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<dfxml version="1.0">\n'
+    yield '  <creator><program>BitCurator Access Webtools</program></creator>\n'
+    yield '  <source><image_filename>%s</image_filename></source>\n' % \
+          escape(image.name.encode('utf-8'))
+    yield '  <volume offset=%s>\n' % quoteattr(str(image_part.start * image.bps))
+    for file_hash in FileHash.forPartition(image_part.id).yield_per(1000):
+        lines = ['    <fileobject>',
+                 '      <filename>%s</filename>' % escape(file_hash.path.encode('utf-8')),
+                 '      <filesize>%d</filesize>' % file_hash.size,
+                 '      <inode>%d</inode>' % file_hash.addr]
+        for digest in MANIFEST_DIGESTS:
+            if getattr(file_hash, digest):
+                lines.append('      <hashdigest type=%s>%s</hashdigest>' %
+                             (quoteattr(digest), getattr(file_hash, digest)))
+        lines.append('    </fileobject>\n')
+        yield '\n'.join(lines)
+    yield '  </volume>\n</dfxml>\n'
+
+def _checkpoint(run, batch):
+    if batch:
+        FileHash.addHashes(batch)
+        run.files += len(batch)
+        run.bytes += sum(entry[FileFlds.SIZE] for entry in batch)
+        del batch[:]
+    HashRun.save(run)
+
+def _exit_message(status):
+    """Describes how a dead worker exited given its wait status, None if it
+    exited normally."""
+    if os.WIFSIGNALED(status):
+        return "killed by signal %d" % os.WTERMSIG(status)
+    if os.WEXITSTATUS(status) != 0:
+        return "exited with status %d" % os.WEXITSTATUS(status)
+    return None
+
+def _records(buff):
+    """Pops the complete length prefixed records from buff[0]."""
+    data = buff[0]
+    offset = 0
+    while len(data) - offset >= RECORD_HEADER.size:
+        length, = RECORD_HEADER.unpack_from(data, offset)
+        end = offset + RECORD_HEADER.size + length
+        if len(data) < end:
+            break
+        yield cPickle.loads(data[offset + RECORD_HEADER.size:end])
+        offset = end
+    buff[0] = data[offset:]
+
+def _send(write_fd, record):
+    data = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+    data = RECORD_HEADER.pack(len(data)) + data
+    while data:
+        data = data[os.write(write_fd, data):]
+
+def _worker(write_fd, image_path, start, block_size, addrs, algorithms):
+    """Runs in a forked worker, hashing the files in addrs, never returns."""
+    code = 0
+    try:
+        # Image handles inherited from the parent share its file offsets
+        ImageHandlePool.invalidate()
+        started = time.time()
+        read = 0
+        for addr in addrs:
+            try:
+                digests, file_read = hash_file(image_path, start, block_size,
+                                               addr, algorithms)
+            except Exception as excep:
+                _send(write_fd, ('error', addr, str(excep)))
+                continue
+            read += file_read
+            _send(write_fd, ('file', addr, digests))
+        seconds = time.time() - started
+        _send(write_fd, ('worker', {
+            'pid': os.getpid(),
+            'files': len(addrs),
+            'bytes': read,
+            'seconds': round(seconds, 3),
+            'mb_per_sec': round(read / (1024.0 * 1024.0) / seconds, 1) if seconds else 0.0
+        }))
+    except BaseException:
+        code = 1
+    finally:
+        os._exit(code)
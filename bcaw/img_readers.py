@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# coding=UTF-8
+#
+# BitCurator Access Webtools (Disk Image Access for the Web)
+# Copyright (C) 2014 - 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""Custom pytsk3 image readers used in place of the stock Img_Info."""
+import logging
+import mmap
+import os
+import threading
+from collections import OrderedDict
+import pytsk3
+
+from const import Extns
+
+class MmapImgInfo(pytsk3.Img_Info):
+    """Img_Info for raw (.dd, .raw, .iso) images that memory maps the image
+    and serves TSK's reads from the mapping. Small metadata reads become page
+    cache lookups rather than a seek and read syscall each, the only copy is
+    the slice handed back to TSK.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        super(MmapImgInfo, self).__init__(url='', type=pytsk3.TSK_IMG_TYPE_EXTERNAL)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def read(self, offset, size):
+        return self._map[offset:offset + size]
+
+    def get_size(self):
+        return self._size
+
+class ChunkCache(object):
+    """Process wide, size bounded LRU cache of decoded image chunks, keyed by
+    image identity and chunk offset. Chunks are CHUNK_SIZE bytes, a multiple
+    of the sector size and the size libewf compresses, so neighbouring TSK
+    reads share decoded chunks rather than decompressing them again.
+    """
+    CHUNK_SIZE = 32 * 1024
+    max_bytes = 0
+    current_bytes = 0
+    hits = 0
+    misses = 0
+    bytes_saved = 0
+    __chunks__ = OrderedDict()
+    __lock__ = threading.RLock()
+
+    @classmethod
+    def configure(cls, max_bytes):
+        """Sets the memory budget in bytes, 0 disables the cache."""
+        with cls.__lock__:
+            cls.max_bytes = max(0, int(max_bytes))
+            cls._evict()
+
+    @classmethod
+    def isEnabled(cls):
+        return cls.max_bytes > 0
+
+    @classmethod
+    def get(cls, key):
+        with cls.__lock__:
+            chunk = cls.__chunks__.pop(key, None)
+            if chunk is None:
+                cls.misses += 1
+                return None
+            cls.__chunks__[key] = chunk
+            cls.hits += 1
+            cls.bytes_saved += len(chunk)
+            return chunk
+
+    @classmethod
+    def put(cls, key, chunk):
+        with cls.__lock__:
+            previous = cls.__chunks__.pop(key, None)
+            if previous is not None:
+                cls.current_bytes -= len(previous)
+            cls.__chunks__[key] = chunk
+            cls.current_bytes += len(chunk)
+            cls._evict()
+
+    @classmethod
+    def stats(cls):
+        """Returns a dictionary of cache counters."""
+        lookups = cls.hits + cls.misses
+        return {
+            'chunks': len(cls.__chunks__),
+            'bytes': cls.current_bytes,
+            'max_bytes': cls.max_bytes,
+            'hits': cls.hits,
+            'misses': cls.misses,
+            'hit_rate': round(float(cls.hits) / lookups, 3) if lookups else 0.0,
+            'bytes_saved': cls.bytes_saved
+        }
+
+    @classmethod
+    def _evict(cls):
+        while cls.__chunks__ and cls.current_bytes > cls.max_bytes:
+            _, chunk = cls.__chunks__.popitem(last=False)
+            cls.current_bytes -= len(chunk)
+
+class CachedImgInfo(pytsk3.Img_Info):
+    """Img_Info that wraps another image reader, splitting TSK's reads into
+    chunk aligned reads served from the shared ChunkCache. Used for EWF
+    images where every read from the wrapped reader means decompression.
+    """
+    def __init__(self, image_info, identity):
+        self._image_info = image_info
+        self._identity = identity
+        self._size = image_info.get_size()
+        super(CachedImgInfo, self).__init__(url='', type=pytsk3.TSK_IMG_TYPE_EXTERNAL)
+
+    def close(self):
+        self._image_info.close()
+
+    def read(self, offset, size):
+        chunk_size = ChunkCache.CHUNK_SIZE
+        end = min(offset + size, self._size)
+        chunk_offset = offset - (offset % chunk_size)
+        data = []
+        while chunk_offset < end:
+            chunk = self._chunk(chunk_offset)
+            if not chunk:
+                break
+            data.append(chunk[max(0, offset - chunk_offset):end - chunk_offset])
+            chunk_offset += chunk_size
+        return b''.join(data)
+
+    def get_size(self):
+        return self._size
+
+    def _chunk(self, chunk_offset):
+        key = (self._identity, chunk_offset)
+        chunk = ChunkCache.get(key)
+        if chunk is None:
+            chunk = self._image_info.read(chunk_offset,
+                                          min(ChunkCache.CHUNK_SIZE,
+                                              self._size - chunk_offset))
+            ChunkCache.put(key, chunk)
+        return chunk
+
+def open_image(image_path, use_mmap=True, identity=None):
+    """Returns an Img_Info for image_path, memory mapped for non-empty raw
+    images if use_mmap is set, otherwise the stock pytsk3 reader. EWF images
+    are wrapped in a CachedImgInfo, keyed by identity, if the ChunkCache is
+    enabled.
+    """
+    if use_mmap and is_raw_path(image_path) and os.path.getsize(image_path) > 0:
+        try:
+            return MmapImgInfo(image_path)
+        except (EnvironmentError, mmap.error):
+            logging.exception("Failed to memory map image: " + image_path)
+    image_info = pytsk3.Img_Info(image_path)
+    if ChunkCache.isEnabled() and is_ewf_path(image_path):
+        return CachedImgInfo(image_info, identity or image_path)
+    return image_info
+
+def is_raw_path(image_path):
+    """Checks if image_path has a raw image extension."""
+    return os.path.splitext(image_path)[1] in Extns.RAW
+
+def is_ewf_path(image_path):
+    """Checks if image_path has an EWF image extension."""
+    return os.path.splitext(image_path)[1] in [Extns.E01, Extns.E01.upper()]
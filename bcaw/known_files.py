@@ -0,0 +1,411 @@
+#!/usr/bin/python
+# coding=UTF-8
+#
+# BitCurator Access Webtools (Disk Image Access for the Web)
+# Copyright (C) 2014 - 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""Known file filtering against local reference hash lists, e.g. the NSRL."""
+import binascii
+import bisect
+import errno
+import fcntl
+import hashlib
+import heapq
+import itertools
+import logging
+import math
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from spool import FILE_MODE, make_shared_dir
+
+SHA1_BYTES = 20
+BUFF_SIZE = 1024 * 1024
+# Digests sorted in memory at once when building a digest file
+SORT_RUN_DIGESTS = 1000000
+# Digest files hold a header, the bloom filter bits then the sorted digests
+DIGEST_FILE_HEADER = struct.Struct('>QQQ')
+DIGEST_FILE_EXTN = '.sha1set'
+
+class BloomFilter(object):
+    """Bloom filter of SHA-1 digests. The digests are already uniformly
+    distributed so bit positions are taken from the digest itself by double
+    hashing rather than by hashing it again.
+    DOCTESTS:
+    >>> bloom = BloomFilter(100, 0.01)
+    >>> bloom.add(binascii.unhexlify('0a4d55a8d778e5022fab701977c5d840bbc486d0'))
+    >>> binascii.unhexlify('0a4d55a8d778e5022fab701977c5d840bbc486d0') in bloom
+    True
+    >>> binascii.unhexlify('da39a3ee5e6b4b0d3255bfef95601890afd80709') in bloom
+    False
+    """
+    __slots__ = ['bits', 'size', 'hashes']
+    HALVES = struct.Struct('>QQ')
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(1, capacity)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(float(self.size) / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    @classmethod
+    def fromBits(cls, bits, size, hashes):
+        """Returns a read only filter over the bits of a built filter."""
+        bloom = cls.__new__(cls)
+        bloom.bits = bits
+        bloom.size = size
+        bloom.hashes = hashes
+        return bloom
+
+    def add(self, digest):
+        for bit in self._positions(digest):
+            self.bits[bit >> 3] |= 1 << (bit & 7)
+
+    def __contains__(self, digest):
+        bits = self.bits
+        for bit in self._positions(digest):
+            if not bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def memorySize(self):
+        return (self.size + 7) // 8
+
+    def _positions(self, digest):
+        first, second = self.HALVES.unpack_from(digest)
+        return ((first + i * second) % self.size for i in xrange(self.hashes))
+
+class KnownHashSet(object):
+    """Exact set of SHA-1 digests held as one sorted byte string of 20 byte
+    digests and searched by bisection, fronted by a BloomFilter so the
+    common case, an unknown file, rarely needs the search. Sets of reference
+    list size are built into a digest file by write_digest_file and memory
+    mapped by load, so every process shares the one copy of the pages.
+    DOCTESTS:
+    >>> known = KnownHashSet.fromHexDigests(['0A4D55A8D778E5022FAB701977C5D840BBC486D0'])
+    >>> known.isKnown('0a4d55a8d778e5022fab701977c5d840bbc486d0')
+    True
+    >>> known.isKnown('da39a3ee5e6b4b0d3255bfef95601890afd80709')
+    False
+    >>> len(known)
+    1
+    """
+    def __init__(self, digests, count, bloom):
+        self.digests = digests
+        self.count = count
+        self.bloom = bloom
+
+    @classmethod
+    def fromHexDigests(cls, hex_digests, error_rate=0.01):
+        """Builds a set in memory, for small lists."""
+        digests = sorted(set(binascii.unhexlify(digest) for digest in hex_digests))
+        bloom = BloomFilter(len(digests), error_rate)
+        for digest in digests:
+            bloom.add(digest)
+        return cls(b''.join(digests), len(digests), bloom)
+
+    @classmethod
+    def load(cls, path):
+        """Memory maps the set in the digest file at path."""
+        with open(path, 'rb') as digest_file:
+            mapped = mmap.mmap(digest_file.fileno(), 0, access=mmap.ACCESS_READ)
+        count, size, hashes = DIGEST_FILE_HEADER.unpack_from(mapped[:DIGEST_FILE_HEADER.size])
+        bloom_start = DIGEST_FILE_HEADER.size
+        digests_start = bloom_start + (size + 7) // 8
+        bloom = BloomFilter.fromBits(MappedBytes(mapped, bloom_start), size, hashes)
+        return cls(MappedBytes(mapped, digests_start), count, bloom)
+
+    def __len__(self):
+        return self.count
+
+    def isKnown(self, sha1):
+        """Checks if the hex SHA-1 digest sha1 is in the set."""
+        if not sha1:
+            return False
+        digest = binascii.unhexlify(sha1)
+        return digest in self.bloom and self._search(digest)
+
+    def memorySize(self):
+        """Returns the bytes held, mapped pages are shared between processes."""
+        return self.count * SHA1_BYTES + self.bloom.memorySize()
+
+    def _search(self, digest):
+        digests = self.digests
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle * SHA1_BYTES
+            candidate = digests[offset:offset + SHA1_BYTES]
+            if candidate < digest:
+                low = middle + 1
+            elif candidate > digest:
+                high = middle
+            else:
+                return True
+        return False
+
+class MappedBytes(object):
+    """Read only byte and slice access to a memory map from an offset, bytes
+    are returned as ints like a bytearray's."""
+    __slots__ = ['mapped', 'start']
+
+    def __init__(self, mapped, start):
+        self.mapped = mapped
+        self.start = start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.mapped[self.start + index.start:self.start + index.stop]
+        return ord(self.mapped[self.start + index])
+
+    def __len__(self):
+        return len(self.mapped) - self.start
+
+class KnownFiles(object):
+    """Process wide known file set, loaded from the configured hash lists on
+    first use. The lists are built into a digest file in cache_dir, once per
+    host rather than per process, that's reused until the lists change. With
+    no lists configured nothing is known.
+    """
+    paths = []
+    error_rate = 0.01
+    cache_dir = os.path.join(tempfile.gettempdir(), 'bcaw-known')
+    __known__ = None
+    __lock__ = threading.Lock()
+
+    @classmethod
+    def configure(cls, paths, error_rate=0.01, cache_dir=None):
+        """Sets the reference hash lists, loaded when next needed, and the
+        directory their digest file is built in."""
+        with cls.__lock__:
+            cls.paths = list(paths or [])
+            cls.error_rate = error_rate
+            if cache_dir is not None:
+                cls.cache_dir = cache_dir
+            cls.__known__ = None
+
+    @classmethod
+    def isEnabled(cls):
+        return bool(cls.paths)
+
+    @classmethod
+    def isKnown(cls, sha1):
+        """Checks if the hex SHA-1 digest sha1 is a known file's."""
+        if not cls.paths:
+            return False
+        return cls._knownSet().isKnown(sha1)
+
+    @classmethod
+    def stats(cls):
+        """Returns a dictionary describing the loaded set."""
+        known = cls.__known__
+        return {
+            'lists': len(cls.paths),
+            'loaded': known is not None,
+            'hashes': len(known) if known is not None else 0,
+            'bytes': known.memorySize() if known is not None else 0
+        }
+
+    @classmethod
+    def digestFilePath(cls):
+        """Returns the path of the digest file for the configured lists, named
+        for the lists' paths, sizes and modification times."""
+        lists = [(path, os.path.getsize(path), os.path.getmtime(path)) for path in cls.paths]
+        name = hashlib.sha1(repr((lists, cls.error_rate))).hexdigest()
+        return os.path.join(cls.cache_dir, name + DIGEST_FILE_EXTN)
+
+    @classmethod
+    def build(cls):
+        """Builds the digest file for the configured lists unless another
+        process has, returns its path."""
+        path = cls.digestFilePath()
+        if os.path.exists(path):
+            return path
+        make_shared_dir(cls.cache_dir)
+        lock_fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, FILE_MODE)
+        try:
+            # Other processes wait for the one building the file
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            if not os.path.exists(path):
+                started = time.time()
+                count = write_digest_file(read_hash_lists(cls.paths), path, cls.error_rate)
+                logging.info("Built %d known hashes into %s in %.1f seconds",
+                             count, path, time.time() - started)
+        finally:
+            os.close(lock_fd)
+        return path
+
+    @classmethod
+    def _knownSet(cls):
+        with cls.__lock__:
+            if cls.__known__ is None:
+                cls.__known__ = KnownHashSet.load(cls.build())
+                logging.info("Loaded %d known hashes", len(cls.__known__))
+            return cls.__known__
+
+class KnownAddrs(object):
+    """Sorted array of the meta addresses of a partition's known files,
+    supporting in and len like the set it replaces in far less memory.
+    DOCTESTS:
+    >>> addrs = KnownAddrs([42, 7, 19])
+    >>> 19 in addrs, 20 in addrs, len(addrs)
+    (True, False, 3)
+    """
+    __slots__ = ['addrs']
+
+    def __init__(self, addrs):
+        self.addrs = array('l', sorted(addrs))
+
+    def __contains__(self, addr):
+        index = bisect.bisect_left(self.addrs, addr)
+        return index < len(self.addrs) and self.addrs[index] == addr
+
+    def __len__(self):
+        return len(self.addrs)
+
+class KnownAddrCache(object):
+    """Per process cache of KnownAddrs keyed by partition and hashing run
+    version, so directory pages don't query every known address of the
+    partition. The max_entries most recently used partitions are kept.
+    """
+    max_entries = 16
+    __entries__ = OrderedDict()
+    __lock__ = threading.Lock()
+
+    @classmethod
+    def get(cls, part_id, version, loader):
+        """Returns the KnownAddrs for the partition's hashing run at version,
+        calling loader() for the addresses if they're not cached."""
+        with cls.__lock__:
+            entry = cls.__entries__.pop(part_id, None)
+            if entry is not None and entry[0] == version:
+                cls.__entries__[part_id] = entry
+                return entry[1]
+        addrs = KnownAddrs(loader())
+        with cls.__lock__:
+            cls.__entries__[part_id] = (version, addrs)
+            while len(cls.__entries__) > cls.max_entries:
+                cls.__entries__.popitem(last=False)
+        return addrs
+
+def write_digest_file(hex_digests, path, error_rate=0.01):
+    """Writes the unique hex_digests as a KnownHashSet digest file at path,
+    returning the number written. Digests are sorted in runs of
+    SORT_RUN_DIGESTS written to temp files then merged, so memory use is
+    bounded whatever the number of digests.
+    """
+    directory = os.path.dirname(path)
+    runs = []
+    unique_path = None
+    try:
+        for chunk in _chunks(hex_digests, SORT_RUN_DIGESTS):
+            runs.append(_writeTemp(directory, b''.join(
+                sorted(set(binascii.unhexlify(digest) for digest in chunk)))))
+        # Merge the runs dropping duplicates, counting the unique digests
+        unique_path = _writeTemp(directory, b'')
+        count = 0
+        previous = None
+        run_files = [open(run, 'rb') for run in runs]
+        try:
+            with open(unique_path, 'wb') as unique:
+                for digest in heapq.merge(*[_readDigests(run) for run in run_files]):
+                    if digest != previous:
+                        unique.write(digest)
+                        count += 1
+                        previous = digest
+        finally:
+            for run in run_files:
+                run.close()
+        bloom = BloomFilter(count, error_rate)
+        with open(unique_path, 'rb') as unique:
+            for digest in _readDigests(unique):
+                bloom.add(digest)
+        handle, temp_path = tempfile.mkstemp(prefix='.', dir=directory)
+        try:
+            os.fchmod(handle, FILE_MODE)
+            with os.fdopen(handle, 'wb') as digest_file, open(unique_path, 'rb') as unique:
+                digest_file.write(DIGEST_FILE_HEADER.pack(count, bloom.size, bloom.hashes))
+                digest_file.write(bloom.bits)
+                shutil.copyfileobj(unique, digest_file, BUFF_SIZE)
+            os.rename(temp_path, path)
+        except:
+            _remove(temp_path)
+            raise
+        return count
+    finally:
+        for run in runs + ([unique_path] if unique_path else []):
+            _remove(run)
+
+def _chunks(iterable, size):
+    chunk = list(itertools.islice(iterable, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterable, size))
+
+def _readDigests(digest_file):
+    return iter(lambda: digest_file.read(SHA1_BYTES), b'')
+
+def _writeTemp(directory, data):
+    handle, temp_path = tempfile.mkstemp(prefix='.', dir=directory)
+    with os.fdopen(handle, 'wb') as temp:
+        temp.write(data)
+    return temp_path
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as excep:
+        if excep.errno != errno.ENOENT:
+            logging.exception("Failed to remove " + path)
+
+def read_hash_lists(paths):
+    """Generator yielding the SHA-1 digests read from the hash list files at
+    paths, lines that don't start with a digest, e.g. headers, are skipped.
+    """
+    for path in paths:
+        with open(path, 'rb') as hash_list:
+            for line in hash_list:
+                digest = parse_hash_line(line)
+                if digest is not None:
+                    yield digest
+
+def parse_hash_line(line):
+    """Returns the SHA-1 digest that starts a hash list line, either a bare
+    digest or the first, quoted, field of an NSRL RDS NSRLFile.txt line.
+    Returns None for any other line.
+    DOCTESTS:
+    >>> parse_hash_line('"0A4D55A8D778E5022FAB701977C5D840BBC486D0","B10A8DB164E0754105B7A99BE72E3FE5","","hello.txt",11,1,"WIN",""')
+    '0a4d55a8d778e5022fab701977c5d840bbc486d0'
+    >>> parse_hash_line('da39a3ee5e6b4b0d3255bfef95601890afd80709  empty\\n')
+    'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+    >>> parse_hash_line('"SHA-1","MD5","CRC32","FileName"') is None
+    True
+    """
+    digest = line.lstrip('"')[:2 * SHA1_BYTES]
+    if len(digest) != 2 * SHA1_BYTES:
+        return None
+    try:
+        binascii.unhexlify(digest)
+    except TypeError:
+        return None
+    return digest.lower()
+
+if __name__ == '__main__':
+    # Builds the digest file ahead of first use, run with the configured
+    # KNOWN_HASH_CACHE_DIR and KNOWN_HASH_LISTS:
+    # $ python bcaw/known_files.py <cache dir> <hash list>...
+    KnownFiles.configure(sys.argv[2:], cache_dir=sys.argv[1])
+    print KnownFiles.build()
@@ -11,9 +11,13 @@
 #
 # model.py holds the database model classes and connection utils
 #
+import datetime
+import json
 import logging
+import zlib
 from flask_sqlalchemy import SQLAlchemy
 from bcaw import app
+from bcaw.const import AnalysisStatus
 
 db = SQLAlchemy(app)
 
@@ -106,6 +110,378 @@ class Partition(db.Model):
         db.session.add(part)
         db.session.commit()
 
+class FileEntry(db.Model):
+    """A catalogued file system entry, one row per directory entry found when
+    walking a partition, so that listings and path resolution can be served
+    by indexed queries rather than reading the image.
+    """
+    __tablename__ = 'file_entry'
+    __table_args__ = (
+        db.Index('ix_file_entry_parent', 'partition_id', 'parent_addr'),
+        db.Index('ix_file_entry_addr', 'partition_id', 'addr'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    addr = db.Column(db.BigInteger)
+    parent_addr = db.Column(db.BigInteger)
+    name = db.Column(db.Text)
+    size = db.Column(db.BigInteger)
+    mode = db.Column(db.Integer)
+    mtime = db.Column(db.BigInteger)
+    atime = db.Column(db.BigInteger)
+    ctime = db.Column(db.BigInteger)
+    is_dir = db.Column(db.Boolean)
+    is_deleted = db.Column(db.Boolean)
+    is_candidate = db.Column(db.Boolean)
+
+    partition_id = db.Column(db.Integer, db.ForeignKey('partition.id'))
+
+    @staticmethod
+    def children(part_id, parent_addr):
+        """Query for the entries of the directory with meta address parent_addr."""
+        return FileEntry.query.filter_by(partition_id=part_id,
+                                         parent_addr=parent_addr)
+
+    @staticmethod
+    def childCount(part_id, parent_addr):
+        return FileEntry.children(part_id, parent_addr).count()
+
+    @staticmethod
+    def byName(part_id, parent_addr, name):
+        return FileEntry.children(part_id, parent_addr).filter_by(name=name).first()
+
+    @staticmethod
+    def byAddr(part_id, addr):
+        return FileEntry.query.filter_by(partition_id=part_id, addr=addr).first()
+
+    @staticmethod
+    def namedByAddr(part_id, addr):
+        """Returns an entry with meta address addr other than a . or .. entry."""
+        return FileEntry.query.filter_by(partition_id=part_id, addr=addr) \
+                              .filter(~FileEntry.name.in_([u'.', u'..'])).first()
+
+    @staticmethod
+    def byPath(part_id, root_addr, path):
+        """Resolves path to an entry one component at a time, returns None
+        for the root directory or if the path isn't found."""
+        entry = None
+        parent_addr = root_addr
+        for name in [name for name in path.split('/') if name]:
+            entry = FileEntry.byName(part_id, parent_addr, name)
+            if entry is None:
+                return None
+            parent_addr = entry.addr
+        return entry
+
+    @staticmethod
+    def addEntries(entries):
+        """Bulk inserts a batch of file entry field maps."""
+        db.session.bulk_insert_mappings(FileEntry, entries)
+        db.session.commit()
+
+    @staticmethod
+    def deleteForPartition(part_id):
+        FileEntry.query.filter_by(partition_id=part_id).delete()
+        db.session.commit()
+
+class Catalog(db.Model):
+    """Records the state of a partition's file system catalog."""
+    __tablename__ = 'catalog'
+    id = db.Column(db.Integer, primary_key=True)
+    root_addr = db.Column(db.BigInteger)
+    entries = db.Column(db.Integer)
+    complete = db.Column(db.Boolean)
+
+    partition_id = db.Column(db.Integer, db.ForeignKey('partition.id'), unique=True)
+
+    def __init__(self, partition_id, root_addr=None, entries=0, complete=False):
+        self.partition_id = partition_id
+        self.root_addr = root_addr
+        self.entries = entries
+        self.complete = complete
+
+    @staticmethod
+    def byPartId(part_id):
+        return Catalog.query.filter_by(partition_id=part_id).first()
+
+    @staticmethod
+    def completeForPartId(part_id):
+        """Returns the partition's catalog if it's complete, otherwise None."""
+        return Catalog.query.filter_by(partition_id=part_id, complete=True).first()
+
+    @staticmethod
+    def save(catalog):
+        db.session.add(catalog)
+        db.session.commit()
+
+class ByteSequence(db.Model):
+    """A unique byte sequence, file content identified by its SHA-1, holding
+    the results of analysing the content. Files with the same content, in any
+    image, share the one sequence so its text is extracted and stored once.
+    Extracted text is stored zlib compressed.
+    """
+    __tablename__ = 'byte_sequence'
+    id = db.Column(db.Integer, primary_key=True)
+    sha1 = db.Column(db.String(40), unique=True)
+    size = db.Column(db.BigInteger)
+    md5 = db.Column(db.String(32))
+    sha256 = db.Column(db.String(64))
+    mime_type = db.Column(db.String(256))
+    is_known = db.Column(db.Boolean)
+    text = db.Column(db.LargeBinary)
+    error = db.Column(db.String(256))
+
+    def __init__(self, digests, size, mime_type=None, full_text=None, error=None,
+                 is_known=False):
+        self.sha1 = digests.get('sha1')
+        self.md5 = digests.get('md5')
+        self.sha256 = digests.get('sha256')
+        self.size = size
+        self.mime_type = mime_type
+        self.setFullText(full_text)
+        self.error = error
+        self.is_known = is_known
+
+    def setFullText(self, full_text):
+        if isinstance(full_text, unicode):
+            full_text = full_text.encode('utf-8')
+        self.text = zlib.compress(full_text) if full_text is not None else None
+
+    def getFullText(self):
+        return zlib.decompress(self.text) if self.text is not None else None
+
+    @staticmethod
+    def bySha1(sha1):
+        return ByteSequence.query.filter_by(sha1=sha1).first()
+
+    @staticmethod
+    def save(sequence):
+        db.session.add(sequence)
+        db.session.commit()
+
+class FileAnalysis(db.Model):
+    """Cached analysis results for a file in a partition, identified by its
+    meta address, so the analysis page doesn't re-extract, identify, hash
+    and textract the file on every visit. The content's results, including
+    its text, are shared with every other copy of the content through its
+    ByteSequence, and copied into the analysis for display and lookup by
+    digest. Text stored by earlier versions is zlib compressed in the
+    analysis itself.
+    """
+    __tablename__ = 'file_analysis'
+    __table_args__ = (
+        db.UniqueConstraint('partition_id', 'addr', name='uq_file_analysis_addr'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    addr = db.Column(db.BigInteger)
+    mime_type = db.Column(db.String(256))
+    sha1 = db.Column(db.String(40), index=True)
+    md5 = db.Column(db.String(32))
+    sha256 = db.Column(db.String(64))
+    is_known = db.Column(db.Boolean)
+    text = db.Column(db.LargeBinary)
+    seconds = db.Column(db.Float)
+    analysed = db.Column(db.DateTime)
+    status = db.Column(db.String(16))
+    error = db.Column(db.String(256))
+    path = db.Column(db.Text)
+
+    partition_id = db.Column(db.Integer, db.ForeignKey('partition.id'))
+    byte_sequence_id = db.Column(db.Integer, db.ForeignKey('byte_sequence.id'))
+    byte_sequence = db.relationship('ByteSequence')
+
+    def __init__(self, partition_id=None, addr=None, mime_type=None, path=None,
+                 seconds=None, analysed=None, status=AnalysisStatus.COMPLETE):
+        self.partition_id = partition_id
+        self.addr = addr
+        self.mime_type = mime_type
+        self.path = path
+        self.seconds = seconds
+        self.analysed = analysed
+        self.status = status
+
+    def setByteSequence(self, sequence):
+        """Links the analysis to the results for its content."""
+        self.byte_sequence = sequence
+        self.mime_type = sequence.mime_type
+        self.sha1 = sequence.sha1
+        self.md5 = sequence.md5
+        self.sha256 = sequence.sha256
+        self.error = sequence.error
+        self.is_known = sequence.is_known
+        self.text = None
+
+    def updateFrom(self, results):
+        """Copies the results of another (unsaved) analysis into this one."""
+        self.setByteSequence(results.byte_sequence)
+        self.path = results.path
+        self.seconds = results.seconds
+        self.analysed = results.analysed
+        self.status = results.status
+
+    def isComplete(self):
+        return self.status == AnalysisStatus.COMPLETE
+
+    def isInProgress(self):
+        return self.status in AnalysisStatus.IN_PROGRESS
+
+    def isFailed(self):
+        return self.status == AnalysisStatus.FAILED
+
+    def toStatusMap(self):
+        """Returns the analysis status and results for status polling."""
+        full_text = self.getFullText() if self.isComplete() else None
+        return {
+            'status': self.status,
+            'mime_type': self.mime_type,
+            'sha1': self.sha1,
+            'md5': self.md5,
+            'sha256': self.sha256,
+            'seconds': self.seconds,
+            'error': self.error,
+            'is_known': self.is_known,
+            'full_text': full_text.decode('utf-8', 'replace') if full_text else None
+        }
+
+    def getFullText(self):
+        if self.byte_sequence is not None:
+            return self.byte_sequence.getFullText()
+        return zlib.decompress(self.text) if self.text is not None else None
+
+    @staticmethod
+    def byAddr(part_id, addr):
+        return FileAnalysis.query.filter_by(partition_id=part_id, addr=addr).first()
+
+    @staticmethod
+    def occurrencesOf(sha1, limit):
+        """Returns up to limit (partition id, meta address, path) tuples of
+        analysed files with the SHA-1 digest sha1."""
+        return db.session.query(FileAnalysis.partition_id, FileAnalysis.addr,
+                                 FileAnalysis.path) \
+                         .filter_by(sha1=sha1, status=AnalysisStatus.COMPLETE) \
+                         .limit(limit).all()
+
+    @staticmethod
+    def addrsForPartId(part_id):
+        """Returns the set of meta addresses analysed for a partition."""
+        return set(row.addr for row in db.session.query(FileAnalysis.addr)
+                   .filter_by(partition_id=part_id))
+
+    @staticmethod
+    def save(analysis):
+        db.session.add(analysis)
+        db.session.commit()
+
+class FileHash(db.Model):
+    """Digests of a file in a partition, stored by a partition hashing run."""
+    __tablename__ = 'file_hash'
+    __table_args__ = (
+        db.UniqueConstraint('partition_id', 'addr', name='uq_file_hash_addr'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    addr = db.Column(db.BigInteger)
+    path = db.Column(db.Text)
+    size = db.Column(db.BigInteger)
+    md5 = db.Column(db.String(32))
+    sha1 = db.Column(db.String(40), index=True)
+    sha256 = db.Column(db.String(64))
+    is_known = db.Column(db.Boolean)
+
+    partition_id = db.Column(db.Integer, db.ForeignKey('partition.id'), index=True)
+
+    @staticmethod
+    def forPartition(part_id):
+        """Query of a partition's file hashes ordered by path."""
+        return FileHash.query.filter_by(partition_id=part_id).order_by(FileHash.path)
+
+    @staticmethod
+    def addrsForPartId(part_id):
+        """Returns the set of meta addresses hashed for a partition."""
+        return set(row.addr for row in db.session.query(FileHash.addr)
+                   .filter_by(partition_id=part_id))
+
+    @staticmethod
+    def byAddr(part_id, addr):
+        return FileHash.query.filter_by(partition_id=part_id, addr=addr).first()
+
+    @staticmethod
+    def occurrencesOf(sha1, limit):
+        """Returns up to limit (partition id, meta address, path) tuples of
+        hashed files with the SHA-1 digest sha1."""
+        return db.session.query(FileHash.partition_id, FileHash.addr, FileHash.path) \
+                         .filter_by(sha1=sha1).limit(limit).all()
+
+    @staticmethod
+    def knownAddrsForPartId(part_id):
+        """Returns the set of meta addresses of a partition's known files."""
+        return set(row.addr for row in db.session.query(FileHash.addr)
+                   .filter_by(partition_id=part_id, is_known=True))
+
+    @staticmethod
+    def totalsForPartId(part_id):
+        """Returns the (files, bytes) hashed for a partition."""
+        files, size = db.session.query(db.func.count(FileHash.id),
+                                       db.func.sum(FileHash.size)) \
+                                .filter_by(partition_id=part_id).one()
+        return files, int(size or 0)
+
+    @staticmethod
+    def addHashes(hashes):
+        """Bulk inserts a batch of file hash field maps."""
+        db.session.bulk_insert_mappings(FileHash, hashes)
+        db.session.commit()
+
+    @staticmethod
+    def deleteForPartition(part_id):
+        FileHash.query.filter_by(partition_id=part_id).delete()
+        db.session.commit()
+
+class HashRun(db.Model):
+    """Progress and throughput of a partition hashing run, the file hashes
+    committed so far are its checkpoint."""
+    __tablename__ = 'hash_run'
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(16))
+    files = db.Column(db.Integer)
+    bytes = db.Column(db.BigInteger)
+    errors = db.Column(db.Integer)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+    # Time of the last save, a queued or running run's heartbeat
+    updated = db.Column(db.DateTime)
+    workers = db.Column(db.Text)
+
+    partition_id = db.Column(db.Integer, db.ForeignKey('partition.id'), unique=True)
+
+    def __init__(self, partition_id, status=AnalysisStatus.QUEUED):
+        self.partition_id = partition_id
+        self.status = status
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def isComplete(self):
+        return self.status == AnalysisStatus.COMPLETE
+
+    def isInProgress(self):
+        return self.status in AnalysisStatus.IN_PROGRESS
+
+    def setWorkerStats(self, worker_stats):
+        self.workers = json.dumps(worker_stats)
+
+    def getWorkerStats(self):
+        """Returns the list of per worker throughput dictionaries."""
+        return json.loads(self.workers) if self.workers else []
+
+    @staticmethod
+    def byPartId(part_id):
+        return HashRun.query.filter_by(partition_id=part_id).first()
+
+    @staticmethod
+    def save(run):
+        run.updated = datetime.datetime.utcnow()
+        db.session.add(run)
+        db.session.commit()
+
 def dbinit():
     db.create_all()
     logging.debug("Database initialised")
@@ -0,0 +1,289 @@
+#!/usr/bin/python
+# coding=UTF-8
+#
+# BitCurator Access Webtools (Disk Image Access for the Web)
+# Copyright (C) 2014 - 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""Managed spool directory for files extracted from images."""
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import stat
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Group read/write so the web and Celery accounts, sharing a group, can both
+# use the directory, set group id so files take the directory's group
+DIR_MODE = 0o2775
+FILE_MODE = 0o664
+
+class SpoolDir(object):
+    """Size bounded directory of files copied out of images, named for the
+    key they're spooled under so concurrent requests for the same file, from
+    any process, share one copy. The directory is shared by the web and Celery
+    processes, files in use are pinned with a shared flock so no process
+    evicts them, the least recently used unpinned files are deleted when the
+    files on disk exceed max_bytes.
+    """
+    directory = os.path.join(tempfile.gettempdir(), 'bcaw-spool')
+    max_bytes = 0
+    # Seconds before a hidden temp file is assumed left by a dead process
+    temp_max_age = 24 * 60 * 60
+    current_bytes = 0
+    files = 0
+    hits = 0
+    misses = 0
+    evictions = 0
+    __pins__ = {}
+    __writing__ = {}
+    __lock__ = threading.Lock()
+
+    @classmethod
+    def configure(cls, directory, max_bytes):
+        """Sets the spool directory and byte quota, creating the directory and
+        deleting stale temp files."""
+        with cls.__lock__:
+            cls.directory = directory
+            cls.max_bytes = max(0, int(max_bytes))
+            make_shared_dir(directory)
+            remove_stale_temps(directory, cls.temp_max_age)
+            cls._scan()
+            cls._evict()
+
+    @classmethod
+    @contextmanager
+    def spooled(cls, key, writer):
+        """Context manager yielding the path of the spooled file for key,
+        calling writer(file_obj) to create it if it isn't spooled. The file
+        won't be evicted until the block exits, it mustn't be modified.
+        """
+        name = hashlib.sha1(repr(key)).hexdigest()
+        path = cls._acquire(name, writer)
+        try:
+            yield path
+        finally:
+            cls._release(name)
+
+    @classmethod
+    def isSpooled(cls, key):
+        """Checks if the file for key is already spooled."""
+        return os.path.exists(os.path.join(cls.directory,
+                                           hashlib.sha1(repr(key)).hexdigest()))
+
+    @classmethod
+    def stats(cls):
+        """Returns a dictionary of spool counters, file and byte counts are
+        as of the last scan of the directory."""
+        with cls.__lock__:
+            lookups = cls.hits + cls.misses
+            return {
+                'directory': cls.directory,
+                'files': cls.files,
+                'bytes': cls.current_bytes,
+                'max_bytes': cls.max_bytes,
+                'in_use': len(cls.__pins__),
+                'hits': cls.hits,
+                'misses': cls.misses,
+                'hit_rate': round(float(cls.hits) / lookups, 3) if lookups else 0.0,
+                'evictions': cls.evictions
+            }
+
+    @classmethod
+    def _acquire(cls, name, writer):
+        path = os.path.join(cls.directory, name)
+        while True:
+            with cls.__lock__:
+                if cls._pin(name, path):
+                    cls.hits += 1
+                    return path
+                written = cls.__writing__.get(name)
+                if written is None:
+                    # This thread writes the file, others here for it wait
+                    written = cls.__writing__[name] = threading.Event()
+                    cls.misses += 1
+                    break
+            written.wait()
+        try:
+            while True:
+                cls._write(path, writer)
+                with cls.__lock__:
+                    # Only lost if another process evicted it straight away
+                    if cls._pin(name, path):
+                        # Rescan to count the files other processes spooled
+                        cls._scan()
+                        cls._evict()
+                        return path
+        finally:
+            with cls.__lock__:
+                del cls.__writing__[name]
+            written.set()
+
+    @classmethod
+    def _pin(cls, name, path):
+        """Pins the spooled file for this process, returns False if it isn't
+        spooled. Call with the lock held."""
+        pinned = cls.__pins__.get(name)
+        if pinned is None:
+            pin_fd = pin_file(path)
+            if pin_fd is None:
+                return False
+            pinned = cls.__pins__[name] = [pin_fd, 0]
+        pinned[1] += 1
+        touch(path)
+        return True
+
+    @classmethod
+    def _write(cls, path, writer):
+        # Write to a hidden temp name then rename, so no process sees a
+        # partial copy
+        handle, temp_path = tempfile.mkstemp(prefix='.', dir=cls.directory)
+        try:
+            os.fchmod(handle, FILE_MODE)
+            with os.fdopen(handle, 'wb') as temp:
+                writer(temp)
+            os.rename(temp_path, path)
+        except:
+            _remove(temp_path)
+            raise
+
+    @classmethod
+    def _release(cls, name):
+        with cls.__lock__:
+            pinned = cls.__pins__[name]
+            pinned[1] -= 1
+            if pinned[1] <= 0:
+                del cls.__pins__[name]
+                os.close(pinned[0])
+            cls._evict()
+
+    @classmethod
+    def _evict(cls):
+        """Deletes the least recently used files not pinned by any process
+        while the directory exceeds the quota. The directory is rescanned
+        as other processes add files too. Call with the lock held."""
+        if cls.current_bytes <= cls.max_bytes:
+            return
+        for _, name, size in sorted(cls._scan()):
+            if cls.current_bytes <= cls.max_bytes:
+                break
+            if name in cls.__pins__ or not remove_unpinned(os.path.join(cls.directory, name)):
+                continue
+            cls.files -= 1
+            cls.current_bytes -= size
+            cls.evictions += 1
+
+    @classmethod
+    def _scan(cls):
+        """Returns the (mtime, name, size) of each spooled file, updating the
+        file and byte counts."""
+        spooled = []
+        for name in os.listdir(cls.directory):
+            if name.startswith('.'):
+                continue
+            try:
+                file_stat = os.stat(os.path.join(cls.directory, name))
+            except OSError:
+                continue
+            spooled.append((file_stat.st_mtime, name, file_stat.st_size))
+        cls.files = len(spooled)
+        cls.current_bytes = sum(size for _, _, size in spooled)
+        return spooled
+
+def make_shared_dir(directory):
+    """Creates directory if need be, group writable for the other account."""
+    try:
+        os.makedirs(directory)
+    except OSError as excep:
+        if excep.errno != errno.EEXIST:
+            raise
+    try:
+        if stat.S_IMODE(os.stat(directory).st_mode) != DIR_MODE:
+            os.chmod(directory, DIR_MODE)
+    except OSError:
+        # Owned by the other account, which set the mode
+        pass
+
+def remove_stale_temps(directory, max_age):
+    """Deletes the hidden temp files under directory older than max_age
+    seconds, left by processes that died writing them. Younger ones may be
+    being written by live processes."""
+    cutoff = time.time() - max_age
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                if name.startswith('.') and os.path.getmtime(path) < cutoff:
+                    _remove(path)
+            except OSError:
+                pass
+
+def pin_file(path):
+    """Opens the file at path holding a shared flock, which stops other
+    processes evicting it, returns the descriptor to close to unpin it, or
+    None if there's no file at path."""
+    while True:
+        try:
+            pin_fd = os.open(path, os.O_RDONLY)
+        except OSError as excep:
+            if excep.errno == errno.ENOENT:
+                return None
+            raise
+        fcntl.flock(pin_fd, fcntl.LOCK_SH)
+        # The file may have been deleted while we waited for the lock
+        try:
+            if os.stat(path).st_ino == os.fstat(pin_fd).st_ino:
+                return pin_fd
+        except OSError:
+            pass
+        os.close(pin_fd)
+        if not os.path.exists(path):
+            return None
+
+def touch(path):
+    """Marks a file as recently used."""
+    try:
+        os.utime(path, None)
+    except OSError:
+        # Not owned by this account, recency is best effort
+        pass
+
+def remove_unpinned(path):
+    """Deletes the file at path unless a process has it pinned, returns True
+    if the file is gone."""
+    try:
+        pin_fd = os.open(path, os.O_RDONLY)
+    except OSError as excep:
+        return excep.errno == errno.ENOENT
+    try:
+        try:
+            fcntl.flock(pin_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as excep:
+            if excep.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        try:
+            if os.stat(path).st_ino != os.fstat(pin_fd).st_ino:
+                # Replaced by a fresh copy since it was opened
+                return False
+        except OSError:
+            return True
+        _remove(path)
+        return True
+    finally:
+        os.close(pin_fd)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as excep:
+        if excep.errno != errno.ENOENT:
+            logging.exception("Failed to remove spooled file " + path)
@@ -12,8 +12,10 @@
 # model.py holds the database model classes and connection utils
 #
 """Utiltiies module, a home to utility classes and methods."""
+import codecs
 import hashlib
 import os.path
+from HTMLParser import HTMLParser
 import magic
 
 MIME_IDENT = magic.Magic(mime=True)
@@ -48,6 +50,38 @@ def identify_mime_path(apath):
     mime_string = MIME_IDENT.from_file(apath)
     return mime_string
 
+def identify_mime_buffer(buff):
+    """Perform Python Magic identification of a buffer, usually the header of
+    a file, returning None if the type can't be decided from the buffer.
+    """
+    mime_string = MIME_IDENT.from_buffer(buff)
+    return mime_string if is_header_decisive(mime_string) else None
+
+# Types libmagic reports for headers that need the rest of the file to decide,
+# zip and OLE containers hold office formats identified by later entries
+HEADER_UNDECIDED = frozenset([
+    "application/octet-stream",
+    "application/zip",
+    "application/CDFV2",
+    "application/CDFV2-unknown",
+    "application/CDFV2-corrupt",
+    "application/vnd.ms-office",
+    "application/x-ole-storage"
+])
+
+def is_header_decisive(mime_type):
+    """Checks if mime_type, identified from a file header, can be trusted
+    without identifying the whole file.
+    DOCTESTS:
+    >>> is_header_decisive('application/pdf')
+    True
+    >>> is_header_decisive('application/zip')
+    False
+    >>> is_header_decisive(None)
+    False
+    """
+    return bool(mime_type) and mime_type not in HEADER_UNDECIDED
+
 def sha1_path(apath):
     """Return the SHA1 of the file at apath."""
     return _hashpath(apath, hashlib.sha1())
@@ -59,6 +93,34 @@ def _hashpath(apath, hasher):
     with open(apath, 'rb') as afile:
         return _hashfile(afile, hasher)
 
+class DigestTee(object):
+    """Passes chunks of content through while updating a digest for each of
+    the hashlib algorithms given, so content is hashed as it streams past
+    rather than in another read of the content.
+    DOCTESTS:
+    >>> tee = DigestTee(['md5', 'sha1'])
+    >>> ''.join(tee.tee(['Hello ', 'World']))
+    'Hello World'
+    >>> tee.hexdigests()['sha1']
+    '0a4d55a8d778e5022fab701977c5d840bbc486d0'
+    >>> tee.hexdigests()['md5']
+    'b10a8db164e0754105b7a99be72e3fe5'
+    """
+    def __init__(self, algorithms):
+        self.hashers = dict((algorithm, hashlib.new(algorithm)) for algorithm in algorithms)
+
+    def tee(self, chunks):
+        """Generator yielding chunks after adding them to each digest."""
+        for chunk in chunks:
+            for hasher in self.hashers.values():
+                hasher.update(chunk)
+            yield chunk
+
+    def hexdigests(self):
+        """Returns a dictionary of hex digests keyed by algorithm name."""
+        return dict((algorithm, hasher.hexdigest())
+                    for algorithm, hasher in self.hashers.items())
+
 def sha1_file(afile, blocksize=65536):
     """Calculates the SHA1 of afile."""
     return _hashfile(afile, hashlib.sha1(), blocksize)
@@ -74,7 +136,173 @@ def _hashfile(afile, hasher, blocksize=65536):
     afile.seek(0)
     return hasher.hexdigest()
 
+# Most distinct ranges served as one multipart response
+MAX_BYTE_RANGES = 16
+
+def parse_byte_ranges(range_header, length, max_ranges=MAX_BYTE_RANGES):
+    """Parses an HTTP Range header into a list of (start, end) byte offset
+    tuples, end exclusive, for content of length bytes. Overlapping and
+    adjacent ranges are merged. Returns an empty list if the header is missing,
+    not a valid bytes range or has more than max_ranges ranges once merged, so
+    the whole content is sent, and None if none of the ranges can be satisfied.
+    DOCTESTS:
+    >>> parse_byte_ranges('bytes=0-499', 1000)
+    [(0, 500)]
+    >>> parse_byte_ranges('bytes=900-', 1000)
+    [(900, 1000)]
+    >>> parse_byte_ranges('bytes=-200', 1000)
+    [(800, 1000)]
+    >>> parse_byte_ranges('bytes=0-9, 20-29, 990-2000', 1000)
+    [(0, 10), (20, 30), (990, 1000)]
+    >>> parse_byte_ranges('bytes=1000-', 1000) is None
+    True
+    >>> parse_byte_ranges('bytes=20-10', 1000)
+    []
+    >>> parse_byte_ranges('items=0-9', 1000)
+    []
+    >>> parse_byte_ranges('bytes=0-,0-,0-', 1000)
+    [(0, 1000)]
+    >>> parse_byte_ranges('bytes=500-599, 0-99, 50-149, 150-199', 1000)
+    [(0, 200), (500, 600)]
+    >>> parse_byte_ranges('bytes=0-0,2-2,4-4', 1000, max_ranges=2)
+    []
+    """
+    if not range_header or not range_header.startswith('bytes='):
+        return []
+    ranges = []
+    for spec in range_header[len('bytes='):].split(','):
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return []
+        try:
+            if not first:
+                # Suffix range, the last N bytes
+                start, end = max(0, length - int(last)), length
+            else:
+                start = int(first)
+                end = min(int(last) + 1, length) if last else length
+        except ValueError:
+            return []
+        if start < 0 or (last and first and int(last) < start):
+            return []
+        if start < end:
+            ranges.append((start, end))
+    if not ranges:
+        return None
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged if len(merged) <= max_ranges else []
+
 def map_mime_to_ext(mime_type):
     if not mime_type:
         return None
     return MIME_TO_EXT.get(mime_type, None)
+
+# Byte order marks checked longest first, UTF-32LE's starts with UTF-16LE's
+BOMS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16')
+]
+
+def detect_encoding(sample):
+    """Returns the name of the codec for text starting with the bytes in
+    sample, from a byte order mark, a valid UTF-8 sample or chardet's guess,
+    falling back to latin-1 which decodes anything.
+    DOCTESTS:
+    >>> detect_encoding(codecs.BOM_UTF16_LE + 'h\\x00i\\x00')
+    'utf-16'
+    >>> detect_encoding('plain ascii')
+    'utf-8'
+    >>> detect_encoding('caf\\xc3\\xa9 \\xe2\\x82')
+    'utf-8'
+    """
+    for bom, encoding in BOMS:
+        if sample.startswith(bom):
+            return encoding
+    try:
+        # Not final, the sample may end part way through a character
+        codecs.getincrementaldecoder('utf-8')().decode(sample, False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    # Only needed for legacy encodings, chardet is installed with textract
+    import chardet
+    guess = chardet.detect(sample)
+    if guess.get('encoding'):
+        try:
+            return codecs.lookup(guess['encoding']).name
+        except LookupError:
+            pass
+    return 'latin-1'
+
+class HtmlText(HTMLParser):
+    """Incremental HTML parser that collects the document's text, skipping
+    scripts and styles and separating blocks with new lines.
+    DOCTESTS:
+    >>> parser = HtmlText()
+    >>> parser.feed(u'<html><head><style>p {}</style><title>T</title></head>')
+    >>> parser.feed(u'<body><p>One &amp; <b>two</b></p><script>x</script><p>3</p>')
+    >>> parser.text()
+    u'T\\nOne & two\\n3'
+    """
+    SKIPPED = frozenset(['script', 'style', 'noscript', 'template'])
+    BLOCKS = frozenset(['address', 'article', 'br', 'div', 'dd', 'dt', 'h1', 'h2',
+                        'h3', 'h4', 'h5', 'h6', 'hr', 'li', 'p', 'pre', 'section',
+                        'td', 'th', 'title', 'tr'])
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.pieces = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED:
+            self.skipping += 1
+        elif tag in self.BLOCKS:
+            self.pieces.append(u'\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in self.BLOCKS:
+            self.pieces.append(u'\n')
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.pieces.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape(u'&%s;' % name))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape(u'&#%s;' % name))
+
+    def text(self):
+        """Returns the text collected so far, one block per line."""
+        lines = (u' '.join(line.split()) for line in u''.join(self.pieces).splitlines())
+        return u'\n'.join(line for line in lines if line)
+
+def json_strings(value):
+    """Generator yielding the keys and string values of decoded JSON.
+    DOCTESTS:
+    >>> list(json_strings({u'a': [u'b', 1, {u'c': u'd'}]}))
+    [u'a', u'b', u'c', u'd']
+    """
+    if isinstance(value, basestring):
+        yield value
+    elif isinstance(value, dict):
+        for key in sorted(value):
+            yield key
+            for string in json_strings(value[key]):
+                yield string
+    elif isinstance(value, list):
+        for item in value:
+            for string in json_strings(item):
+                yield string
@@ -12,50 +12,40 @@
 # This file contains celery support code for the BitCurator Access Webtools application.
 #
 
-from flask import Flask, current_app
 from bcaw import app
 from celery import Celery
 import bcaw
-from bcaw import *
-
-# FIXME: The following are already defined in bcaw_default_Settings.py.
-# Need to figure out how to include that file here so the following 2 lines
-# can be removed.
-app.config['CELERY_BROKER_URL'] = 'amqp://guest@localhost//'
-app.config['CELERY_RESULT_BACKEND'] = 'amqp://guest@localhost//'
+import bcaw.analysis
+import bcaw.catalog
+import bcaw.hashing
 
+# The broker and result backend are configured in bcaw/config.py
 celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
 celery.conf.update(app.config)
 
 @celery.task(bind=True)
-def bcawIndexAsynchronously(self):
-    """ This is the Celery worker task which is run in parallel with the
-        bcaw app. When user chooses to generate Lucene indexes for the disk
-        images, the mail app (bcaw) calls this worker thread which in turn,
-        invokes the indexing routine.
-        This task is invoked by the following command:
+def bcawBuildCatalogAsynchronously(self, part_id):
+    """ Background task to build the file system catalog for a partition.
+        Tasks are run by the Celery worker started with:
         $ celery -A bcaw_celery_task.celery  worker --loglevel=INFO
     """
+    with app.app_context():
+        bcaw.catalog.build_catalog(part_id)
 
-    """ Background task to index the files """
-    # print "[D]: Task_id: ", self.request.id
+@celery.task(bind=True)
+def bcawAnalysePartitionAsynchronously(self, part_id, candidates_only=True):
+    """ Background task to fill the analysis cache for a partition """
     with app.app_context():
-        # print "Calling bcawIndexAllFiles..."
-        # print "Current app: ", current_app.name
-        bcaw.image_browse.bcawIndexAllFiles(self.request.id)
+        bcaw.analysis.prefill_partition(part_id, candidates_only)
 
 @celery.task(bind=True)
-def bcawBuildDfxmlTableAsynchronously(self):
-    """ Background task to build dfxml table """
+def bcawAnalyseFileAsynchronously(self, part_id, addr, path):
+    """ Background task to analyse a single file, extracting its text """
     with app.app_context():
-        # print "Calling dbBuildDb for DFXML..."
-        # print "Current app: ", current_app.name
-        bcaw.bcaw_db.dbBuildDb(self.request.id, bld_imgdb = False, bld_dfxmldb = True)
+        bcaw.analysis.run_analysis(part_id, addr, path)
 
 @celery.task(bind=True)
-def bcawBuildAllTablesAsynchronously(self):
-    """ Background task to build image and dfxml table """
+def bcawHashPartitionAsynchronously(self, part_id):
+    """ Background task to hash every file in a partition """
     with app.app_context():
-        # print "Calling dbBuildDb for DFXML..."
-        # print "Current app: ", current_app.name
-        bcaw.bcaw_db.dbBuildDb(self.request.id, bld_imgdb = True, bld_dfxmldb = True)
+        bcaw.hashing.hash_partition(part_id)
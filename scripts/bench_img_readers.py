@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# coding=UTF-8
+#
+# BitCurator Access Webtools (Disk Image Access for the Web)
+# Copyright (C) 2014 - 2016
+# All rights reserved.
+#
+# This code is distributed under the terms of the GNU General Public
+# License, Version 3. See the text file "COPYING" for further details
+# about the terms of this license.
+#
+"""Compares the stock pytsk3 image reader against the memory mapped reader
+for a full directory walk and extraction of every regular file.
+
+Usage: bench_img_readers.py [--cold] <raw image> [partition byte offset]
+                            [repetitions]
+
+The readers are run repetitions times, default 3, alternating which runs
+first so neither always reads a page cache the other warmed. With --cold the
+page cache is dropped before every run, which needs root, for cold cache
+timings, otherwise only the first run is cold and the medians are warm cache
+timings.
+"""
+import os
+import sys
+import time
+import pytsk3
+
+# Import the readers without initialising the Flask application
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'bcaw'))
+from img_readers import MmapImgInfo
+
+BUFF_SIZE = 1024 * 1024
+DROP_CACHES = '/proc/sys/vm/drop_caches'
+READERS = [('stock', pytsk3.Img_Info), ('mmap', MmapImgInfo)]
+
+def walk(fs_info):
+    """Returns the meta addresses of every regular file on the file system."""
+    files = []
+    pending = [fs_info.info.root_inum]
+    visited = set(pending)
+    while pending:
+        for entry in fs_info.open_dir(inode=pending.pop()):
+            meta = entry.info.meta
+            if meta is None or entry.info.name.name in ['.', '..']:
+                continue
+            if meta.type == pytsk3.TSK_FS_META_TYPE_DIR:
+                if meta.addr not in visited:
+                    visited.add(meta.addr)
+                    pending.append(meta.addr)
+            elif meta.type == pytsk3.TSK_FS_META_TYPE_REG:
+                files.append(meta.addr)
+    return files
+
+def extract(fs_info, addrs):
+    """Reads the content of every file in addrs, returns bytes read."""
+    total = 0
+    for addr in addrs:
+        image_file = fs_info.open_meta(inode=addr)
+        size = image_file.info.meta.size
+        offset = 0
+        while offset < size:
+            data = image_file.read_random(offset, min(BUFF_SIZE, size - offset))
+            if not data:
+                break
+            offset += len(data)
+        total += offset
+    return total
+
+def drop_caches():
+    """Writes dirty pages out then drops the page cache, needs root."""
+    os.system('sync')
+    with open(DROP_CACHES, 'w') as drop:
+        drop.write('3\n')
+
+def bench(name, image_info, offset):
+    """Walks and extracts the file system, returns (walk, extract) seconds."""
+    fs_info = pytsk3.FS_Info(image_info, offset=offset)
+    start = time.time()
+    addrs = walk(fs_info)
+    walked = time.time() - start
+    start = time.time()
+    total = extract(fs_info, addrs)
+    extracted = time.time() - start
+    print "%-8s walk: %8.3fs (%d files)  extract: %8.3fs (%.1f MB/s)" % \
+          (name, walked, len(addrs), extracted,
+           total / (1024.0 * 1024.0) / extracted if extracted else 0.0)
+    return walked, extracted
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+def main(args):
+    cold = '--cold' in args
+    args = [arg for arg in args if arg != '--cold']
+    if not args:
+        print __doc__
+        return 1
+    if cold and not os.access(DROP_CACHES, os.W_OK):
+        print "--cold needs root to write " + DROP_CACHES
+        return 1
+    offset = int(args[1]) if len(args) > 1 else 0
+    repetitions = int(args[2]) if len(args) > 2 else 3
+    timings = dict((name, []) for name, _ in READERS)
+    for repetition in range(repetitions):
+        # Alternate the order so each reader runs first as often
+        readers = READERS if repetition % 2 == 0 else READERS[::-1]
+        for name, reader in readers:
+            if cold:
+                drop_caches()
+            timings[name].append(bench(name, reader(args[0]), offset))
+    print "Median of %d %s cache runs:" % (repetitions, 'cold' if cold else 'warm')
+    for name, _ in READERS:
+        print "%-8s walk: %8.3fs  extract: %8.3fs" % \
+              (name, median([walked for walked, _ in timings[name]]),
+               median([extracted for _, extracted in timings[name]]))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))